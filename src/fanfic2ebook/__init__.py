@@ -21,13 +21,8 @@ Features:
  - Support transparently resuming from gzip/bzip2-compressed save sets.
  - Support custom path generation and a config file so I can automatically
    save to "~/Documents/Fanfiction/<series>/<story>/<story> - <chapter>.html"
- - I suspect it's not an encoding issue but a font issue that keeps certain
-   accented characters from displaying in the Sony PRS-505. Offer an option to
-   convert them to rough equivalents which can be displayed. (Common latin1
-   accents like é and ï work but stuff like ō shows as whitespace) Make it default
-   when the fanfic2lrf personality is active.
-    - Use code from http://stackoverflow.com/questions/517923/what-is-the-best-way-to-remove-accents-in-a-python-unicode-string
-    - Test with all accents I can find and provide a whitelist of ones supported by the PRS-505.
+ - Test --strip-accents with all accents I can find and refine the PRS-505
+   whitelist in preprocessing.py accordingly.
  - fanfic2lrf doesn't do a line break if you go foo</p>bar, so I need to ensure all
    text is in paragraph elements or equivalent.
  - Finish re-architecting this so it meets my non-drowsy standards.
@@ -45,15 +40,204 @@ __version__ = "0.1pre2"
 __siteurl__ = "http://github.com/ssokolow/fanfic2ebook/tree/master"
 
 # stdlib imports
-import os, subprocess
+import copy, multiprocessing, os, subprocess
+from multiprocessing.pool import ThreadPool
+
+# lxml imports
+from lxml import html
 
 # Local imports
+from data_structures import atomic_write
+from events import Events, ProgressDisplay
+from library import Library
 from personalities import Personality
+from preprocessing import AccentStripper
 from scrapers import Scraper, HTTP
 
 # Set the User-Agent string
 HTTP.set_base_UA('%s/%s +%s' % (__appname__, __version__, __siteurl__))
 
+def load_personalities(names, opts):
+    """Instantiate the named personalities and apply their changes to opts.
+
+    When several personalities share a run, boolean options they enable
+    (eg. C{bundle}) stay enabled so the single bundle suits all of them.
+    The exception is C{strip_accents}, which is device-specific: the shared
+    bundle is only stripped if every personality wants it and the others get
+    a stripped copy of their own. (See L{run_personalities})
+
+    For other options, the last personality wins and a warning is printed
+    if they disagree. (Except C{final_ext}, which each personality keeps
+    for its own output file)
+
+    @param names: Personality names. Each may be a comma-separated list.
+    @param opts: The parsed command-line options. (Modified in place)
+    @type names: C{list} of C{str}
+
+    @return: The L{Personality} instances in the order given.
+    @rtype: C{list} of L{Personality}
+    """
+    personas = [Personality.get(name.strip())()
+                for arg in names for name in arg.split(',') if name.strip()]
+    chosen = {}
+    for persona in personas:
+        for option, value in persona.opts.items():
+            if option == 'strip_accents':
+                continue
+            if isinstance(value, bool):
+                value = value or getattr(opts, option, False)
+            elif (option != 'final_ext' and option in chosen
+                    and chosen[option][1] != value):
+                print "WARNING: %s and %s disagree on %s. Using %r." % (
+                        chosen[option][0], persona.name, option, value)
+            chosen[option] = (persona.name, value)
+            setattr(opts, option, value)
+
+    if personas and all(x.opts.get('strip_accents') for x in personas):
+        opts.strip_accents = True
+
+    if opts.postproc or opts.volume_chapters or opts.volume_size:
+        opts.bundle = True
+    return personas
+
+def run_personalities(personas, story):
+    """Run each personality's post-processing against the story's bundle or,
+    if it was split into volumes, against every volume.
+
+    When there's more than one conversion to do, they run concurrently (up
+    to one per CPU, but always one per personality). With more than one
+    personality, each gets its own copy of the story whose C{final_path}
+    carries that personality's extension, and a per-format result is
+    printed. Personalities which want accents stripped get a stripped copy
+    of the HTML if the story's own copy wasn't.
+
+    @return: Success by personality name. (False if any volume failed)
+    @rtype: C{dict}
+    """
+    volumes = getattr(story, 'volumes', None) or [story]
+    tasks = [(persona, volume) for persona in personas for volume in volumes]
+    results = dict((persona.name, True) for persona in personas)
+
+    def run(task):
+        persona, target = task
+        target = copy.copy(target)
+        if len(personas) > 1 and hasattr(target, 'final_path'):
+            target.final_path = os.path.splitext(target.final_path)[0] + persona.opts.get(
+                    'final_ext', os.path.splitext(target.final_path)[1])
+        if (persona.opts.get('strip_accents') and hasattr(target, 'path')
+                and not getattr(target, 'accents_stripped', False)):
+            target.path = write_stripped_copy(target.path)
+
+        Events.emit('postproc_start', personality=persona.name, title=target.title)
+        try:
+            success = persona.postproc(target) is not False
+        except Exception, err:
+            print "%s failed: %s" % (persona.name, err)
+            success = False
+        if not success:
+            results[persona.name] = False
+        Events.emit('postproc_finish', personality=persona.name, title=target.title,
+                    success=success)
+
+    if len(tasks) == 1:
+        run(tasks[0])
+    else:
+        pool = ThreadPool(min(len(tasks),
+                              max(multiprocessing.cpu_count(), len(personas))))
+        pool.map(run, tasks)
+        pool.close()
+        pool.join()
+    if len(personas) > 1:
+        for persona in personas:
+            print "%s: %s" % (persona.name, results[persona.name] and "OK" or "FAILED")
+    return results
+
+def write_stripped_copy(path):
+    """Write a copy of a bundle run through L{AccentStripper} next to it.
+    (For personalities which need it when the shared bundle isn't stripped)
+
+    @return: The path of the copy.
+    @rtype: str
+    """
+    dom = html.parse(path).getroot()
+    AccentStripper()(dom)
+    stripped_path = os.path.splitext(path)[0] + '.stripped.html'
+    atomic_write(stripped_path, html.tostring(dom))
+    return stripped_path
+
+def process_story(scraper, url, story, personas, opts):
+    """Retrieve a story and run the personalities and any post-processors on it.
+
+    @param scraper: The L{Scraper} to retrieve the story with.
+    @param url: The URL of any chapter in the story.
+    @param story: See L{Scraper.download_fic}.
+    @param personas: The L{Personality} objects whose post-processing should
+        be applied. (See L{run_personalities})
+    @param opts: The parsed command-line options.
+
+    @return: The retrieved L{Story} with a C{formats} property holding
+        the L{run_personalities} results.
+    @rtype: L{Story}
+    """
+    downloaded_story = scraper.download_fic(url, story)
+    downloaded_story.formats = run_personalities(personas, downloaded_story)
+
+    if opts.postproc:
+        inputs = {
+            'appname'   : "%s v%s" % (__appname__, __version__),
+            'author'    : downloaded_story.author,
+            'bundle'    : downloaded_story.path,
+            'category'  : downloaded_story.category,
+            'coverfile' : downloaded_story.cover,
+            'outfile'   : downloaded_story.final_path,
+            'site_name' : downloaded_story.site_name,
+            'title'     : downloaded_story.title
+        }
+
+        for pp_cmdline in opts.postproc:
+            cmdlist = pp_cmdline.strip().split()
+            print "Calling post-processor: %s" % cmdlist[0]
+            subprocess.call([r % inputs for r in cmdlist])
+
+    return downloaded_story
+
+def serve(opts, default_persona, pool=None):
+    """Run the job server (See L{server}) until interrupted.
+
+    @param opts: The parsed command-line options. (Used as defaults for jobs)
+    @param default_persona: The personality names used for jobs which
+        don't specify any.
+    """
+    from server import JobServer
+    warm_http, scrapers, asset_stores = HTTP(), {}, {}
+
+    def run_job(job):
+        job_opts = copy.copy(opts)
+        job_opts.target = job['target'] or opts.target
+        personas = load_personalities(job['personality'] and [job['personality']]
+                                      or default_persona, job_opts)
+
+        # Reuse scrapers (and one shared HTTP object) between jobs
+        scraper_class = Scraper.get(job['url'])
+        key = (scraper_class, job_opts.target, job_opts.bundle,
+               job_opts.final_ext, job_opts.strip_accents)
+        if opts.images and job_opts.target not in asset_stores:
+            from assets import AssetStore
+            asset_stores[job_opts.target] = AssetStore(job_opts.target)
+        if key not in scrapers:
+            scrapers[key] = scraper_class(*(key[1:] + (pool,
+                                asset_stores.get(job_opts.target))))
+            scrapers[key].http = warm_http
+        return process_story(scrapers[key], job['url'], None, personas, job_opts)
+
+    host, _, port = opts.listen.rpartition(':')
+    job_server = JobServer((host or '127.0.0.1', int(port)), run_job, opts.target)
+    print "Accepting jobs on http://%s:%s/jobs" % job_server.server_address
+    try:
+        job_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
 def main():
     from optparse import OptionParser, OptionGroup
 
@@ -72,15 +256,85 @@ def main():
                             "with chapter headings and a table of contents.")
     parser.add_option('-t', '--target', action="store", dest="target", metavar="DIR",
         default=os.getcwd(), help="Specify a target directory other than the current working directory.")
+    parser.add_option('-a', '--author', action="store_true", dest="author",
+        default=False, help="Treat the given URLs as author pages and retrieve " +
+                            "every listed story not already present in the target directory.")
+    parser.add_option('--sweep', action="store_true", dest="sweep",
+        default=False, help="Check every story in the target directory for new " +
+                            "chapters and retrieve any found. Takes no URLs.")
+    parser.add_option('-j', '--processes', action="store", type="int", dest="processes",
+        metavar="N", default=0, help="Parse and clean chapters in a pool of N " +
+                                     "worker processes while downloading continues.")
+    parser.add_option('--stream', action="store_true", dest="stream",
+        default=False, help="Parse pages as they download rather than after. " +
+                            "Saves memory on huge chapters but bypasses the HTTP cache.")
+    parser.add_option('--daemon', action="store_true", dest="daemon",
+        default=False, help="Stay resident and accept jobs over a local " +
+                            "HTTP/JSON API instead of processing URLs.")
+    parser.add_option('--listen', action="store", dest="listen", metavar="HOST:PORT",
+        default='127.0.0.1:8642', help="Address for --daemon to listen on. " +
+                                       "(default: %default)")
+    parser.add_option('-i', '--images', action="store_true", dest="images",
+        default=False, help="Keep images and retrieve them (and covers) into a " +
+                            "shared, deduplicated store in the target directory.")
+    parser.add_option('--progress', action="store_true", dest="progress",
+        default=False, help="Show a live progress line with throughput and per-host request rates.")
+    parser.add_option('--stats-file', action="store", dest="stats_file", metavar="FILE",
+        default=None, help="Append per-site network statistics for this run to FILE " +
+                           "as a line of JSON.")
+    parser.add_option('--record', action="store", dest="record", metavar="FILE",
+        default=None, help="Append every HTTP response to an archive file for later --replay.")
+    parser.add_option('--replay', action="store", dest="replay", metavar="FILE",
+        default=None, help="Serve every HTTP request from an archive made with " +
+                           "--record instead of the network.")
     parser.add_option('--list_supported', action="store_true", dest="list_supported",
         default=False, help="List installed scrapers and personalities.")
-    parser.add_option('-P', '--personality', action="store", dest="persona", metavar="NAME",
-        default=None, help="Set the personality the conversion will operate under. See --list_supported.")
+    parser.add_option('-P', '--personality', action="append", dest="persona", metavar="NAME",
+        default=[], help="Set the personality the conversion will operate under. See --list_supported. " +
+                         "Can be used multiple times or given a comma-separated list to " +
+                         "produce several formats from one bundle.")
+
+    pre_group = OptionGroup(parser, "Pre-Processing Options")
+    pre_group.add_option('--strip-accents', action="store_true", dest="strip_accents",
+        default=False, help="Remove diacritics for compatibility with readers with " +
+        "limited fonts and no internal fallback mechanism. (eg. Sony PRS-505) " +
+        "Default for fanfic2lrf.")
+    parser.add_option_group(pre_group)
+
+    sweep_group = OptionGroup(parser, "Sweep Options")
+    sweep_group.add_option('--max-age', action="store", type="float", dest="max_age",
+        metavar="DAYS", default=None, help="Don't check stories which haven't " +
+        "changed in this many days.")
+    sweep_group.add_option('--per-site', action="store", type="int", dest="per_site",
+        metavar="N", default=None, help="Check at most N stories per site.")
+    parser.add_option_group(sweep_group)
 
-    #pre_group = OptionGroup(parser, "Pre-Processing Options")
-    #pre_group.add_option('--strip-accents', action="store_true", dest="strip_accents",
-    #    default=False, help="Remove diacritics for compatibility with readers with " +
-    #    "limited fonts and no internal fallback mechanism. (eg. Sony PRS-505)")
+    cache_group = OptionGroup(parser, "Cache Options",
+        "Move the HTTP cache between machines so new ones don't have to " +
+        "retrieve everything from the sites again.")
+    cache_group.add_option('--export-cache', action="store", dest="export_cache",
+        metavar="FILE", default=None, help="Write the HTTP cache to a compressed pack and exit.")
+    cache_group.add_option('--import-cache', action="store", dest="import_cache",
+        metavar="FILE", default=None, help="Merge a pack made by --export-cache into " +
+        "the HTTP cache and exit.")
+    cache_group.add_option('--cache-site', action="append", dest="cache_sites",
+        metavar="HOST", default=[], help="Only export entries from this site. " +
+        "Can be used multiple times.")
+    cache_group.add_option('--cache-max-age', action="store", type="float",
+        dest="cache_max_age", metavar="DAYS", default=None,
+        help="Only export entries cached in the last DAYS days.")
+    parser.add_option_group(cache_group)
+
+    dist_group = OptionGroup(parser, "Distributed Options",
+        "Share work between several nodes through a job store (an SQLite " +
+        "file on shared storage). Jobs are sharded by site so only one worker " +
+        "anywhere retrieves from a given site at a time.")
+    dist_group.add_option('--queue', action="store", dest="queue", metavar="FILE",
+        default=None, help="Add the stories which would be retrieved (including " +
+        "those found by --author or --sweep) to a job store instead.")
+    dist_group.add_option('--worker', action="store", dest="worker", metavar="FILE",
+        default=None, help="Retrieve stories from a job store until none remain queued.")
+    parser.add_option_group(dist_group)
 
     pp_group = OptionGroup(parser, "Post-Processing Options")
     pp_group.add_option('-p', '--postproc', action="append", dest="postproc", metavar="CMD",
@@ -89,6 +343,14 @@ def main():
     pp_group.add_option('-e', '--final_ext', action="store", dest="final_ext", metavar="EXT",
         default='.out', help="Set the extension to be used in the output filename " +
                            "available to post-processor templates.")
+    pp_group.add_option('--volume-chapters', action="store", type="int",
+        dest="volume_chapters", metavar="N", default=None, help="Also split the " +
+        "bundle into volumes of at most N chapters and convert those instead. " +
+        "Implies --bundle.")
+    pp_group.add_option('--volume-size', action="store", type="int",
+        dest="volume_size", metavar="KiB", default=None, help="Also split the " +
+        "bundle into volumes of about this size and convert those instead. " +
+        "Implies --bundle.")
     parser.add_option_group(pp_group)
 
     opts, args = parser.parse_args()
@@ -101,44 +363,128 @@ def main():
         print "Personalities:\n\t" + '\n\t'.join(sorted(Personality.personalities))
         parser.exit()
 
-    if not args:
+    if opts.export_cache or opts.import_cache:
+        import cache
+        if opts.export_cache:
+            done, skipped = cache.export_cache(HTTP.get_cache_dir(), opts.export_cache,
+                                               opts.cache_sites, opts.cache_max_age)
+            print "Exported %d cache entries to %s (%d filtered out)" % (
+                    done, opts.export_cache, skipped)
+        if opts.import_cache:
+            done, skipped = cache.import_cache(HTTP.get_cache_dir(), opts.import_cache)
+            print "Imported %d cache entries from %s (%d skipped)" % (
+                    done, opts.import_cache, skipped)
+        parser.exit()
+
+    if not args and not (opts.sweep or opts.daemon or opts.worker):
         parser.print_help()
         parser.exit()
 
-    persona = Personality.get(opts.persona or cmd)()
-    for option in persona.opts:
-        setattr(opts, option, persona.opts[option])
+    HTTP.stream = opts.stream
+    Scraper.volume_chapters = opts.volume_chapters
+    Scraper.volume_bytes = opts.volume_size and opts.volume_size * 1024
 
-    if opts.postproc:
-        opts.bundle = True
+    if opts.record and opts.replay:
+        parser.error("--record and --replay are mutually exclusive")
+    elif opts.record or opts.replay:
+        from archive import HTTPArchive
+        HTTP.archive = HTTPArchive(opts.record or opts.replay, replay=bool(opts.replay))
+
+    progress = None
+    if opts.progress:
+        progress = ProgressDisplay()
+        Events.subscribe(progress)
+        progress.capture_stdout()
 
-    for url_arg in args:
-        scraper = Scraper.get(url_arg)(opts.target, opts.bundle, opts.final_ext)
+    pool = None
+    if opts.processes > 0:
+        multiprocessing.freeze_support() # Needed for py2exe builds
+        pool = multiprocessing.Pool(opts.processes)
+
+    if opts.daemon:
+        serve(opts, opts.persona or [cmd], pool)
+        parser.exit()
+
+    personas = load_personalities(opts.persona or [cmd], opts)
+
+    assets = None
+    if opts.images:
+        from assets import AssetStore
+        assets = AssetStore(opts.target)
+
+    make_scraper = lambda url: Scraper.get(url)(opts.target, opts.bundle,
+                                    opts.final_ext, opts.strip_accents, pool, assets)
+
+    if opts.sweep:
+        jobs = Library(opts.target).sweep(make_scraper, opts.max_age, opts.per_site)
+    else:
+        jobs = []
+
+    if opts.author:
+        story_urls = []
+        for author_url in args:
+            scraper_class = Scraper.get_for_author(author_url)
+            if not scraper_class:
+                print "Not a supported author page: %s" % author_url
+                continue
+            scraper = scraper_class(opts.target, opts.bundle, opts.final_ext,
+                                    opts.strip_accents, pool, assets)
+            stories = scraper.list_author_stories(author_url)
+            queued = scraper.filter_known_stories(stories)
+            print "Queued %d of %d stories from %s" % (len(queued), len(stories), author_url)
+            story_urls.extend(queued)
+        args = story_urls
+
+    if opts.queue:
+        from jobstore import JobStore
+        store, added = JobStore(opts.queue), 0
+        for url in [x[1] for x in jobs] + args:
+            if not Scraper.get(url):
+                print "Not a supported story URL: %s" % url
+            elif store.add(url):
+                added += 1
+        print "Queued %d new jobs in %s" % (added, opts.queue)
+        store.close()
+        parser.exit()
+
+    jobs.extend((make_scraper(url), url, None) for url in args)
+
+    for scraper, url_arg, story in jobs:
         try:
-            downloaded_story = scraper.download_fic(url_arg)
+            process_story(scraper, url_arg, story, personas, opts)
         except Exception, err:
+            Events.emit('error', url=url_arg, error=err)
             print "Failed to retrieve story %s" % url_arg
             print "TODO: Handle this properly"
             continue
 
-        persona.postproc(downloaded_story)
-
-        if opts.postproc:
-            inputs = {
-                'appname'   : "%s v%s" % (__appname__, __version__),
-                'author'    : downloaded_story.author,
-                'bundle'    : downloaded_story.path,
-                'category'  : downloaded_story.category,
-                'coverfile' : downloaded_story.cover,
-                'outfile'   : downloaded_story.final_path,
-                'site_name' : downloaded_story.site_name,
-                'title'     : downloaded_story.title
-            }
-
-            for pp_cmdline in opts.postproc:
-                cmdlist = pp_cmdline.strip().split()
-                print "Calling post-processor: %s" % cmdlist[0]
-                subprocess.call([r % inputs for r in cmdlist])
+    if opts.worker:
+        from jobstore import JobStore
+        store = JobStore(opts.worker)
+        for job_id, url_arg in store.claim_all():
+            error = None
+            try:
+                with store.keep_alive(job_id):
+                    process_story(make_scraper(url_arg), url_arg, None, personas, opts)
+            except Exception, error:
+                Events.emit('error', url=url_arg, error=error)
+                print "Failed to retrieve story %s" % url_arg
+            if not store.finish(job_id, error):
+                print "Lease on %s expired. Another worker has taken it over." % url_arg
+        print "Job store %s: %s" % (opts.worker, ', '.join("%d %s" % (count, state)
+                for state, count in sorted(store.counts().items())))
+        store.close()
+
+    if progress:
+        progress.finish()
+    if HTTP.stats.hosts:
+        print "Network usage by site:"
+        for line in HTTP.stats.report():
+            print "  " + line
+        if opts.stats_file:
+            HTTP.stats.append_to(opts.stats_file)
+    if HTTP.archive:
+        HTTP.archive.close()
 
 if __name__ == '__main__':
 	main()
\ No newline at end of file
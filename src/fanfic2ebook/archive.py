@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Record/replay HTTP archives for fanfic2ebook
+
+An archive is a single file of self-delimiting records (in the spirit of
+WARC) so it can be appended to safely and indexed with one pass over the
+record headers without decompressing anything. Each record is::
+
+    F2E1 <status> <compressed length> <url>\\n
+    <zlib-compressed body>\\n
+
+In replay mode, every request L{HTTP<scrapers.HTTP>} makes is served from
+the archive and nothing touches the network, which makes scraper debugging,
+regression runs, and benchmarks reproducible.
+"""
+
+__appname__ = "Fanfic Downloader for Pocket eBook Readers"
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import os, threading, zlib
+
+from scrapers import prnt
+
+class HTTPArchive(object):
+    """A compact, indexed store of HTTP responses."""
+    magic = 'F2E1' #: Record header prefix and format version.
+
+    def __init__(self, path, replay=False):
+        """
+        @param path: The archive file. Created if recording to a new file.
+            Recording to an existing archive appends to it after dropping
+            any partial record a killed run left at the end.
+        @param replay: Serve requests from the archive rather than recording.
+        @type path: str
+        @type replay: bool
+
+        @raise IOError: The archive is missing (replay mode) or corrupt.
+        """
+        self.path   = path
+        self.replay = replay
+        self.lock   = threading.Lock()
+        self.index  = {}
+
+        if replay:
+            self.handle = open(path, 'rb')
+            self.build_index()
+        else:
+            self.handle = open(path, 'a+b')
+            self.build_index(truncate=True)
+
+    def build_index(self, truncate=False):
+        """Map each URL to its most recent record by scanning the headers.
+
+        @param truncate: Cut off a partial record at the end of the file
+            rather than treating it as corruption.
+        @raise IOError: A record is malformed or its body isn't followed by
+            the record separator.
+        """
+        size = os.fstat(self.handle.fileno()).st_size
+        self.handle.seek(0)
+        while True:
+            start = self.handle.tell()
+            header = self.handle.readline()
+            if not header:
+                break
+            try:
+                magic, status, length, url = header.rstrip('\n').split(' ', 3)
+                if magic != self.magic:
+                    raise ValueError(magic)
+                status, length = int(status), int(length)
+            except ValueError:
+                if truncate and not header.endswith('\n'):
+                    return self.truncate(start)
+                raise IOError("Corrupt archive record at byte %d: %s" % (start, self.path))
+
+            offset = self.handle.tell()
+            if offset + length + 1 > size and truncate:
+                return self.truncate(start)
+            self.handle.seek(offset + length)
+            if offset + length + 1 > size or self.handle.read(1) != '\n':
+                raise IOError("Corrupt archive record at byte %d: %s" % (start, self.path))
+            self.index[url] = (offset, length, status)
+
+    def truncate(self, size):
+        """Drop everything after the first C{size} bytes of the archive."""
+        self.handle.truncate(size)
+        prnt("Removed a partial record from the end of %s" % self.path)
+
+    def get(self, url):
+        """Retrieve a recorded response.
+
+        @return: The status code and body.
+        @rtype: (C{int}, C{str})
+        @raise KeyError: The URL was never recorded.
+        """
+        offset, length, status = self.index[url]
+        with self.lock:
+            self.handle.seek(offset)
+            data = self.handle.read(length)
+        return status, zlib.decompress(data)
+
+    def add(self, url, status, content):
+        """Append a response to the archive. (Thread-safe)"""
+        data = zlib.compress(content, 9)
+        with self.lock:
+            self.handle.write("%s %d %d %s\n" % (self.magic, status, len(data), url))
+            self.handle.write(data)
+            self.handle.write("\n")
+            self.handle.flush()
+
+    def close(self):
+        self.handle.close()
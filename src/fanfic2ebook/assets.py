@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""Image and cover retrieval for fanfic2ebook
+
+Images are fetched in background threads while chapters continue to
+download and are stored once per unique content (by SHA-1) in a directory
+shared by every story in the target directory.
+
+If PIL is installed, images are also shrunk to fit L{AssetStore.max_size}
+and converted to greyscale since they'll end up on an e-ink screen anyway.
+"""
+
+__appname__ = "Fanfic Downloader for Pocket eBook Readers"
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import hashlib, os, posixpath, threading, urlparse
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+from data_structures import atomic_write
+from scrapers import HTTP, prnt
+
+class AssetStore(object):
+    """A content-addressed store for images referenced by stories."""
+    dirname  = 'images'      #: Name of the store's directory within the target directory.
+    max_size = (600, 800)    #: Images larger than this are shrunk. (Sony PRS-505 screen size)
+    threads  = 4             #: Number of concurrent image downloads.
+
+    def __init__(self, target_dir):
+        """
+        @param target_dir: The directory stories are being saved into.
+            The store is created as a subdirectory of it.
+        @type target_dir: str
+        """
+        self.directory = os.path.join(target_dir, self.dirname)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self.results = {}
+        self.pool    = ThreadPool(self.threads)
+        self.local   = threading.local()
+
+    def submit(self, url):
+        """Queue a URL for retrieval unless it already has been.
+
+        @return: The retrieval's C{AsyncResult} or None if C{url} isn't
+            an HTTP(S) URL.
+        """
+        if url and url.startswith(('http://', 'https://')):
+            if url not in self.results:
+                self.results[url] = self.pool.apply_async(self.fetch, (url,))
+            return self.results[url]
+        return None
+
+    def prefetch(self, dom):
+        """Queue every image referenced in a DOM for retrieval.
+
+        @type dom: C{lxml.html.HtmlElement}
+        @return: The C{AsyncResult}s of the DOM's retrievals.
+        @rtype: C{list}
+        """
+        results = [self.submit(img.get('src')) for img in dom.iter('img')]
+        return [x for x in results if x]
+
+    def get(self, url):
+        """Wait for a queued URL to finish retrieving.
+
+        @return: The local path or None if it wasn't queued or failed.
+        @rtype: C{str}|C{None}
+        """
+        if url not in self.results:
+            return None
+        try:
+            return self.results[url].get()
+        except Exception, err:
+            prnt("Failed to retrieve image %s: %s" % (url, err))
+            return None
+
+    def rewriter(self, fic_target):
+        """Build a preprocessor (See L{Story.write<data_structures.Story.write>})
+        which points images at their local copies.
+
+        @param fic_target: The directory the file being written will be in.
+        @type fic_target: str
+        """
+        def rewrite(dom):
+            for img in dom.iter('img'):
+                local = self.get(img.get('src'))
+                if local:
+                    img.set('src', os.path.relpath(local, fic_target).replace(os.sep, '/'))
+            return dom
+        return rewrite
+
+    def fetch(self, url):
+        """Retrieve, deduplicate, and resize a single image.
+        (Runs in a worker thread)
+
+        @return: The local path to the stored image.
+        @rtype: str
+        """
+        # httplib2.Http objects aren't thread-safe
+        if not hasattr(self.local, 'http'):
+            self.local.http = HTTP()
+        content = self.local.http.get_content(url)
+
+        digest = hashlib.sha1(content).hexdigest()
+        ext = posixpath.splitext(urlparse.urlparse(url).path)[1].lower() or '.img'
+        content, ext = self.shrink(content, ext)
+
+        path = os.path.join(self.directory, digest + ext)
+        if not os.path.exists(path):
+            atomic_write(path, content)
+        return path
+
+    def shrink(self, content, ext):
+        """Fit an image to L{max_size} and convert it to greyscale if PIL is
+        available. Otherwise, return it unchanged.
+
+        @return: The new image data and file extension.
+        @rtype: (C{str}, C{str})
+        """
+        if Image is None:
+            return content, ext
+
+        try:
+            img = Image.open(StringIO(content))
+            fmt = img.format == 'JPEG' and 'JPEG' or 'PNG'
+            img = img.convert('L')
+            img.thumbnail(self.max_size, Image.ANTIALIAS)
+
+            out = StringIO()
+            img.save(out, fmt)
+            return out.getvalue(), fmt == 'JPEG' and '.jpg' or '.png'
+        except IOError:
+            return content, ext # Not something PIL understands. Store as-is.
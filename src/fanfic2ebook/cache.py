@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""A process-safe HTTP cache for fanfic2ebook
+
+httplib2's C{FileCache} writes entries in place and has no locking, so
+several fanfic2ebook processes sharing L{HTTP.get_cache_dir<scrapers.HTTP.get_cache_dir>}
+can read half-written entries and will all fetch the same URL at once.
+
+This module fixes both:
+ - L{SharedFileCache} writes entries atomically. (See L{atomic_write})
+ - L{InFlightLock} serializes requests for the same URL across processes
+   (and threads) so that, when two workers want the same page, one fetches
+   it and the other waits and then takes the fetched copy from the cache.
+   (See L{SharedFileCache.stamp})
+
+It also provides L{export_cache} and L{import_cache} for seeding a new
+machine's cache from an existing one rather than from the sites.
+"""
+
+__appname__ = "Fanfic Downloader for Pocket eBook Readers"
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import errno, hashlib, os, re, tarfile, time, urlparse
+import httplib2
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+from data_structures import atomic_write
+
+class SharedFileCache(httplib2.FileCache):
+    """A C{httplib2.FileCache} which is safe for concurrent processes."""
+    writes = 0 #: Entries written by this instance. (Used to spot revalidations)
+
+    def set(self, key, value):
+        atomic_write(os.path.join(self.cache, self.safe(key)), value)
+        self.writes += 1
+
+    def delete(self, key):
+        try:
+            os.remove(os.path.join(self.cache, self.safe(key)))
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise # Someone else beating us to it is fine.
+
+    def get_path(self, url):
+        """Return the path of the entry httplib2 would use for C{url}."""
+        return os.path.join(self.cache, self.safe(httplib2.urlnorm(url)[3]))
+
+    def stamp(self, url):
+        """Identify the current version of a URL's entry so a caller that
+        waited on an L{InFlightLock} can tell whether the lock's previous
+        holder stored a new one in the meantime.
+
+        @return: An opaque value or None if there's no entry.
+        """
+        try:
+            stat = os.stat(self.get_path(url))
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime
+
+    def get_response(self, url):
+        """Read a URL's entry directly, ignoring httplib2's freshness rules.
+        (Which would refetch responses without a max-age or with no-cache)
+
+        @return: The status code and body or None if there's no usable entry.
+        @rtype: (C{int}, C{str})|C{None}
+        """
+        entry = self.get(httplib2.urlnorm(url)[3])
+        if not entry or '\r\n\r\n' not in entry:
+            return None
+        headers, content = entry.split('\r\n\r\n', 1)
+        status = re.match(r'status: (\d+)', headers)
+        return status and (int(status.group(1)), content) or None
+
+class InFlightLock(object):
+    """An exclusive, blocking, cross-process lock on a single URL.
+
+    Use as a context manager. Lock files are kept in a C{.locks} directory
+    inside the cache and are left in place afterward since removing them
+    safely would require a second lock. To keep their number bounded, URLs
+    share lock files by hash prefix. (See L{prefix_len})
+    """
+    prefix_len = 3 #: Hex digits of the URL's SHA-1 used to name lock files. (4096 files at most)
+
+    def __init__(self, cachedir, url):
+        """
+        @param cachedir: The shared cache directory.
+        @param url: The URL about to be requested.
+        @type cachedir: str
+        @type url: str
+        """
+        lockdir = os.path.join(cachedir, '.locks')
+        if not os.path.isdir(lockdir):
+            try:
+                os.makedirs(lockdir)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+        self.path   = os.path.join(lockdir, hashlib.sha1(url).hexdigest()[:self.prefix_len])
+        self.handle = None
+
+    def __enter__(self):
+        self.handle = open(self.path, 'a+b')
+        if fcntl:
+            # flock() locks are per open file, so this works between threads too.
+            fcntl.flock(self.handle.fileno(), fcntl.LOCK_EX)
+        else:
+            self.handle.seek(0)
+            while True:
+                try:
+                    # Gives up after ~10 seconds so keep trying.
+                    msvcrt.locking(self.handle.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:
+                    pass
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl:
+            fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
+        else:
+            self.handle.seek(0)
+            msvcrt.locking(self.handle.fileno(), msvcrt.LK_UNLCK, 1)
+        self.handle.close()
+        self.handle = None
+
+def get_entry_url(path):
+    """Read the URL a cache entry was retrieved from out of its headers.
+
+    @return: The URL or None if the entry doesn't record one.
+    @rtype: C{str}|C{None}
+    """
+    handle = open(path, 'rb')
+    try:
+        for line in handle:
+            line = line.strip()
+            if not line:
+                break # End of headers
+            name, _, value = line.partition(':')
+            if name.lower() == 'content-location':
+                return value.strip()
+    finally:
+        handle.close()
+    return None
+
+def export_cache(cachedir, pack_path, sites=None, max_age=None):
+    """Write the entries in an HTTP cache to a single gzipped tarball.
+
+    @param cachedir: The cache to export. (See L{HTTP.get_cache_dir<scrapers.HTTP.get_cache_dir>})
+    @param pack_path: The pack file to create.
+    @param sites: If given, only export entries retrieved from these hosts
+        or their subdomains.
+    @param max_age: If given, only export entries cached in the last
+        C{max_age} days.
+    @type cachedir: str
+    @type pack_path: str
+    @type sites: C{list} of C{str}
+    @type max_age: C{int}|C{float}
+
+    @return: The number of entries exported and skipped.
+    @rtype: (C{int}, C{int})
+    """
+    sites = [x.lower() for x in sites or []]
+    cutoff = max_age is not None and time.time() - max_age * 86400 or None
+    exported, skipped = 0, 0
+
+    pack = tarfile.open(pack_path, 'w:gz')
+    try:
+        for fname in sorted(os.listdir(cachedir)):
+            path = os.path.join(cachedir, fname)
+            if fname.startswith('.') or not os.path.isfile(path):
+                continue # Lock files and temporaries from atomic_write
+            if cutoff and os.path.getmtime(path) < cutoff:
+                skipped += 1
+                continue
+            if sites:
+                host = urlparse.urlparse(get_entry_url(path) or '').hostname or ''
+                if not [x for x in sites if host == x or host.endswith('.' + x)]:
+                    skipped += 1
+                    continue
+            pack.add(path, fname)
+            exported += 1
+    finally:
+        pack.close()
+    return exported, skipped
+
+def import_cache(cachedir, pack_path):
+    """Merge a pack made by L{export_cache} into an HTTP cache.
+
+    Entries are written atomically (so a running fanfic2ebook can keep using
+    the cache) and keep their original timestamps. Entries the cache
+    already holds a newer copy of are left alone.
+
+    @return: The number of entries imported and skipped.
+    @rtype: (C{int}, C{int})
+    """
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    imported, skipped = 0, 0
+
+    pack = tarfile.open(pack_path, 'r:*')
+    try:
+        for member in pack:
+            fname = os.path.basename(member.name)
+            if not member.isfile() or fname != member.name or fname.startswith('.'):
+                skipped += 1 # Never trust a pack to stay inside the cache
+                continue
+
+            path = os.path.join(cachedir, fname)
+            if os.path.exists(path) and os.path.getmtime(path) >= member.mtime:
+                skipped += 1
+                continue
+            atomic_write(path, pack.extractfile(member).read())
+            os.utime(path, (member.mtime, member.mtime))
+            imported += 1
+    finally:
+        pack.close()
+    return imported, skipped
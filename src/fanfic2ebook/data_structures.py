@@ -5,8 +5,8 @@ __appname__ = "Fanfic Downloader for Pocket eBook Readers"
 __author__  = "Stephan Sokolow (deitarion/SSokolow)"
 __license__ = "GNU GPL 2.0 or later"
 
-import os
-from lxml import html
+import copy, hashlib, os, tempfile
+from lxml import etree, html
 from lxml.html import builder as E
 from lxml.html.clean import Cleaner
 
@@ -16,6 +16,67 @@ content_cleaner = Cleaner(scripts=True, javascript=True, comments=True,
         forms=True, annoying_tags=True, remove_unknown_tags=True,
         safe_attrs_only=True, remove_tags=['img']
         ) #: Used to sanitize chapter content.
+image_cleaner = Cleaner(scripts=True, javascript=True, comments=True,
+        style=True, links=False, meta=True, page_structure=True,
+        processing_instructions=True, embedded=True, frames=True,
+        forms=True, annoying_tags=True, remove_unknown_tags=True,
+        safe_attrs_only=True
+        ) #: Like L{content_cleaner} but keeps images. (See L{assets})
+
+# os.umask() can only be read by setting it, which isn't safe once threads
+# are writing files, so read it once while the module is imported.
+_umask = os.umask(0)
+os.umask(_umask)
+
+def atomic_write(path, data):
+    """Write C{data} to C{path} via a temporary file and a rename so that an
+    interrupted run can never leave a truncated file behind.
+
+    If the file already on disk has the same content hash, it is left
+    untouched. (Saves I/O on network storage and keeps backup tools from
+    re-copying unchanged files)
+
+    @param path: The path to write the content to.
+    @param data: The serialized content.
+    @type path: str
+    @type data: str
+
+    @return: True if the file was written. False if it was already current.
+    @rtype: bool
+    """
+    if os.path.isfile(path):
+        digest, existing = hashlib.sha1(), open(path, 'rb')
+        try:
+            for block in iter(lambda: existing.read(65536), ''):
+                digest.update(block)
+        finally:
+            existing.close()
+        if digest.digest() == hashlib.sha1(data).digest():
+            return False
+
+    parent, fname = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % fname, suffix='.tmp', dir=parent)
+    try:
+        outfile = os.fdopen(fd, 'wb')
+        try:
+            outfile.write(data)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        finally:
+            outfile.close()
+
+        # mkstemp() creates files as 0600. Match what open() would have done.
+        os.chmod(tmp_path, 0666 & ~_umask)
+
+        # os.rename() won't replace an existing file on Windows.
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
 
 class Story(object):
     """The in-memory representation of a story."""
@@ -24,6 +85,10 @@ class Story(object):
     chapters = None
     category = ''
     cover    = ''
+    source_url = None #: The URL the story was retrieved from. (Used by sweeps)
+    toc      = None #: (number, title) pairs read by L{iter_html} if present.
+    series   = None #: The full story's title if this is a volume. (See L{split_volumes})
+    volume   = None #: The 1-based volume number if this is a volume.
 
     def __init__(self, title, author, chapters=None):
         """
@@ -65,6 +130,50 @@ class Story(object):
                 print "WARNING: Overwriting existing chapter %d" % chapter_pos
             self.chapters[chapter_pos] = chapter_obj
 
+    def split_volumes(self, max_chapters=None, max_bytes=None):
+        """Divide the story into consecutive volumes for readers and
+        converters which struggle with huge files.
+
+        A volume ends once it holds C{max_chapters} chapters or when the next
+        chapter would push its content past C{max_bytes} of serialized HTML.
+        A chapter larger than C{max_bytes} on its own gets a volume to itself.
+
+        @param max_chapters: The maximum number of chapters per volume.
+        @param max_bytes: The approximate maximum size of a volume.
+        @type max_chapters: int
+        @type max_bytes: int
+
+        @return: Copies of this story holding only their own chapters, with
+            L{series} and L{volume} set and the volume number appended to
+            the title. A one-item list containing this story itself if it
+            doesn't need splitting.
+        @rtype: C{list} of L{Story}
+        """
+        groups, size = [[]], 0
+        for chapter_num in sorted(self.chapters):
+            chapter = self.chapters[chapter_num]
+            length = max_bytes and len(html.tostring(chapter.content)) or 0
+            if groups[-1] and ((max_chapters and len(groups[-1]) >= max_chapters) or
+                               (max_bytes and size + length > max_bytes)):
+                groups.append([])
+                size = 0
+            groups[-1].append(chapter)
+            size += length
+
+        if len(groups) == 1:
+            return [self]
+
+        volumes = []
+        for index, chapters in enumerate(groups):
+            volume = copy.copy(self)
+            volume.chapters = {}
+            volume.add_chapters(chapters)
+            volume.title  = "%s - Volume %d" % (self.title, index + 1)
+            volume.series = self.title
+            volume.volume = index + 1
+            volumes.append(volume)
+        return volumes
+
     def to_dom(self, only_chapter=None):
         """Generate a clean HTML DOM from the stored information.
 
@@ -103,40 +212,121 @@ class Story(object):
                 body.append(chapter.to_dom())
 
         # Add the header and top-level element
-        document = E.HTML(E.HEAD(E.TITLE(self.title)), body)
+        head = E.HEAD(E.TITLE(self.title))
+        if self.source_url:
+            head.append(E.META(name='source', content=self.source_url))
+
+        document = E.HTML(head, body)
         return document
 
-    def write(self, path, only_chapter=None):
+    def write(self, path, only_chapter=None, preprocessors=()):
         """Serialize to file using L{to_dom}.
 
+        The write is atomic and skipped entirely if the file on disk already
+        holds identical content. (See L{atomic_write})
+
         @param path: The path to write the content to.
         @param only_chapter: See L{to_dom}.
+        @param preprocessors: Callables to be applied to the generated DOM
+            before serialization. (eg. L{AccentStripper<preprocessing.AccentStripper>})
         @type path: str
         @type only_chapter: int
+        @type preprocessors: iterable of callables
+
+        @return: True if the file was written. False if it was already current.
+        @rtype: bool
         """
-        outfile = open(path, 'w')
-        outfile.write(html.tostring(self.to_dom(only_chapter)))
-        outfile.close()
+        dom = self.to_dom(only_chapter)
+        for preprocessor in preprocessors:
+            preprocessor(dom)
+        return atomic_write(path, html.tostring(dom))
 
     @staticmethod
-    def from_html(path):
-        """Load a story and any available chapters from a DOM, path, string, or
-        file-like object.
-
-        @param path: A DOM, path, string, or file-like object
-            originating with L{to_dom}.
-        @type path: C{basestring} or file-like object
+    def from_html(path, first=None, last=None, metadata_only=False):
+        """Load a story and any available chapters from a path or file-like
+        object. See L{iter_html} for the arguments.
 
         @return: A Story object.
         @rtype: L{Story}"""
-        doc = html.parse(path).getroot()
-        story = Story(
-            doc.get_element_by_id('title').text,
-            doc.get_element_by_id('author').text)
+        chapters = Story.iter_html(path, first, last, metadata_only)
+        story = chapters.next()
+        for chapter in chapters:
+            story.add_chapters(chapter)
+        return story
 
-        for chapter in doc.find_class('chapter'):
-            story.add_chapters(Chapter.from_html(chapter))
+    @staticmethod
+    def iter_html(path, first=None, last=None, metadata_only=False):
+        """Incrementally load a story from a path or file-like object.
+
+        The file is fed to the parser in blocks and each chapter is discarded
+        from the parse tree once it has been yielded, so memory use stays
+        proportional to the largest chapter rather than the whole bundle.
+        Parsing stops as soon as nothing more is needed.
+
+        Chapters written by L{to_dom} are already clean, so they aren't run
+        through the cleaner again.
+
+        @param path: A path or file-like object originating with L{to_dom}.
+        @param first: The first chapter number to load. (1-based, inclusive)
+        @param last: The last chapter number to load. (inclusive)
+        @param metadata_only: Stop after the title, author, and table of
+            contents (L{toc}) without loading any chapters.
+        @type path: C{basestring} or file-like object
+        @type first: int
+        @type last: int
+        @type metadata_only: bool
+
+        @return: A generator which yields the L{Story} (without chapters)
+            followed by each requested L{Chapter} in file order.
+        """
+        handle = isinstance(path, basestring) and open(path, 'rb') or path
+        parser = etree.HTMLPullParser(events=('end',))
+        parser.set_element_class_lookup(html.HtmlElementClassLookup())
+
+        meta, story = {}, None
+        try:
+            for block in iter(lambda: handle.read(65536), ''):
+                parser.feed(block)
+                for _, elem in parser.read_events():
+                    if elem.tag == 'meta' and elem.get('name') == 'source':
+                        meta['source_url'] = elem.get('content')
+                    elif elem.get('id') in ('title', 'author'):
+                        meta[elem.get('id')] = elem.text
+                    elif elem.get('id') == 'toc':
+                        meta['toc'] = [(int(x.get('href').lstrip('#chapter_')), x.text or '')
+                                       for x in elem.iterfind('.//a[@href]')]
+                    elif 'chapter' in (elem.get('class') or '').split():
+                        if story is None:
+                            story = Story._from_meta(meta)
+                            yield story
+                            if metadata_only:
+                                return
+
+                        number = int(elem.find_class('chapter_num')[0].get('name').lstrip('chapter_'))
+                        if last is not None and number > last:
+                            return
+                        if first is None or number >= first:
+                            chapter = Chapter.from_html(elem, clean=False)
+                            chapter.content.getparent().remove(chapter.content)
+                            yield chapter
+
+                        # Free everything parsed so far
+                        elem.clear()
+                        while elem.getprevious() is not None:
+                            del elem.getparent()[0]
+        finally:
+            if handle is not path:
+                handle.close()
+
+        if story is None:
+            yield Story._from_meta(meta)
 
+    @staticmethod
+    def _from_meta(meta):
+        """Build a chapterless L{Story} from the fields gathered by L{iter_html}."""
+        story = Story(meta.get('title'), meta.get('author'))
+        story.source_url = meta.get('source_url')
+        story.toc = meta.get('toc')
         return story
 
 class Chapter(object):
@@ -145,16 +335,23 @@ class Chapter(object):
     title   = None
     content = None
 
-    def __init__(self, number, title, content):
+    def __init__(self, number, title, content, clean=True):
         """
         @param  number: The chapter's position in the story.
         @param   title: The chapter's title.
         @param content: The actual chapter content.
+        @param   clean: The C{Cleaner} to sanitize C{content} with.
+            True means L{content_cleaner}. Set to False if C{content} has
+            already been cleaned.
         @type  number: int
         @type   title: basestring
         @type content: lxml.html.HtmlElement
+        @type   clean: bool or C{lxml.html.clean.Cleaner}
         """
-        content_cleaner(content)
+        if clean is True:
+            content_cleaner(content)
+        elif clean:
+            clean(content)
 
         self.number  = number
         self.title   = title
@@ -178,11 +375,13 @@ class Chapter(object):
         )
 
     @staticmethod
-    def from_html(html_in):
+    def from_html(html_in, clean=image_cleaner):
         """Load a chapter from a DOM, path, string, or file-like object
 
         @param html_in: An lxml HTML DOM, path, string, or file-like object
             containing a chapter written out by L{to_dom}.
+        @param clean: See L{__init__}. Any images present were deliberately
+            kept, so L{image_cleaner} is the default.
         @type html_in: C{lxml.html.HtmlElement},C{basestring}, or file-like object
 
         @return: A Chapter object.
@@ -198,4 +397,5 @@ class Chapter(object):
         return Chapter(
             int(doc.find_class('chapter_num')[0].get('name').lstrip('chapter_')),
             chapter_title,
-            doc.find_class('content')[0].getchildren()[0])
\ No newline at end of file
+            doc.find_class('content')[0].getchildren()[0],
+            clean)
\ No newline at end of file
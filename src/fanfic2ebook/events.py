@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Progress events for fanfic2ebook
+
+Listeners registered with L{Events.subscribe} are called as
+C{listener(event, data)} where C{data} is a dict. The events are:
+
+ - C{story_start}: C{url}, C{title}, C{chapters} (total count)
+ - C{chapter}: C{url}, C{host}, C{number}, C{skipped} (already on disk)
+ - C{story_finish}: C{url}, C{title}, C{chapters}
+ - C{fetch}: C{url}, C{host}, C{bytes}, C{cached}, C{revalidated}, C{status}, C{elapsed}
+ - C{postproc_start}: C{personality}, C{title}
+ - C{postproc_finish}: C{personality}, C{title}, C{success}
+ - C{error}: C{url}, C{error}
+
+C{fetch} may be emitted from image download threads. (See L{assets})
+"""
+
+__appname__ = "Fanfic Downloader for Pocket eBook Readers"
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import sys, threading, time
+from collections import deque
+
+class Events(object):
+    """A class-level registry of event listeners."""
+    listeners = [] #: Callables registered with L{subscribe}
+
+    @classmethod
+    def subscribe(cls, listener):
+        """Register a callable to receive all events."""
+        cls.listeners.append(listener)
+
+    @classmethod
+    def unsubscribe(cls, listener):
+        """Stop sending events to a previously-registered callable."""
+        cls.listeners.remove(listener)
+
+    @classmethod
+    def emit(cls, event, **data):
+        """Send an event to every registered listener."""
+        for listener in cls.listeners:
+            listener(event, data)
+
+class ProgressDisplay(object):
+    """A one-line live progress display showing overall chapter throughput,
+    the current story's ETA, and per-host request rates.
+
+    Call L{capture_stdout} to keep regular output from landing in the middle
+    of the line."""
+    interval = 0.25 #: Minimum seconds between redraws.
+    window   = 30.0 #: Seconds of history used for per-host rates.
+
+    def __init__(self, stream=sys.stderr):
+        self.stream     = stream
+        self.stdout     = None
+        self.lock       = threading.RLock()
+        self.started    = time.time()
+        self.last_draw  = 0
+        self.last_len   = 0
+        self.stories    = 0
+        self.chapters   = 0
+        self.bytes      = 0
+        self.hits       = 0
+        self.fetches    = 0
+        self.errors     = 0
+        self.remaining  = 0
+        self.host_times = {}
+
+    def __call__(self, event, data):
+        with self.lock:
+            now = time.time()
+            if event == 'story_start':
+                self.remaining = data['chapters']
+            elif event == 'story_finish':
+                self.stories += 1
+                self.remaining = 0
+            elif event == 'chapter':
+                self.remaining = max(self.remaining - 1, 0)
+                if not data['skipped']:
+                    self.chapters += 1
+            elif event == 'fetch':
+                self.fetches += 1
+                self.bytes   += data['bytes'] or 0
+                self.hits    += data['cached'] and 1 or 0
+                self.host_times.setdefault(data['host'], deque()).append(now)
+            elif event == 'error':
+                self.errors += 1
+
+            if now - self.last_draw >= self.interval or event == 'story_finish':
+                self.draw(now)
+
+    def draw(self, now):
+        """Redraw the status line."""
+        self.last_draw = now
+        rate = self.chapters / max(now - self.started, 0.001)
+
+        hosts, span = [], min(self.window, max(now - self.started, 1.0))
+        for host, times in sorted(self.host_times.items()):
+            while times and now - times[0] > self.window:
+                times.popleft()
+            hosts.append("%s %.1f/s" % (host, len(times) / span))
+
+        line = "%d stories | %d chapters (%.2f/s) | %.1f KiB | cache %d/%d" % (
+                self.stories, self.chapters, rate, self.bytes / 1024.0,
+                self.hits, self.fetches)
+        if self.remaining and rate:
+            line += " | ETA %ds" % (self.remaining / rate)
+        if self.errors:
+            line += " | %d errors" % self.errors
+        if hosts:
+            line += " | " + ', '.join(hosts)
+
+        # Pad rather than use ANSI escapes so this works in cmd.exe too
+        self.stream.write("\r" + line.ljust(self.last_len))
+        self.stream.flush()
+        self.last_len = len(line)
+
+    def clear(self):
+        """Blank out the status line and return the cursor to its start."""
+        if self.last_len:
+            self.stream.write("\r" + " " * self.last_len + "\r")
+            self.stream.flush()
+            self.last_len = 0
+
+    def capture_stdout(self):
+        """Route C{sys.stdout} through the display so each line printed
+        clears the status line first and redraws it afterward."""
+        self.stdout, sys.stdout = sys.stdout, _InterleavedStream(self, sys.stdout)
+
+    def finish(self):
+        """Draw the final state, move to a new line, and release
+        C{sys.stdout} if captured."""
+        with self.lock:
+            self.draw(time.time())
+            self.stream.write("\n")
+            self.last_len = 0
+            if self.stdout:
+                sys.stdout, self.stdout = self.stdout, None
+
+class _InterleavedStream(object):
+    """A file-like wrapper used by L{ProgressDisplay.capture_stdout}."""
+    def __init__(self, display, stream):
+        self.display = display
+        self.stream  = stream
+
+    def write(self, data):
+        with self.display.lock:
+            self.display.clear()
+            self.stream.write(data)
+            if data.endswith('\n'):
+                self.stream.flush()
+                self.display.draw(time.time())
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
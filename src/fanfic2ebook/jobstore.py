@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""A job queue shared between worker nodes for fanfic2ebook
+
+Story URLs are queued in an SQLite database which every worker opens (eg.
+on shared storage) and are claimed one at a time. Jobs are sharded by site
+host: claiming a job also leases its host, so no two workers anywhere are
+ever retrieving from the same site at once, and a host isn't handed out
+again until L{JobStore.host_delay} seconds after its last job finished.
+That keeps each site's politeness limits global rather than per-node.
+
+Workers renew their lease while a job runs (See L{JobStore.keep_alive})
+so a worker which dies only holds its host until L{JobStore.lease_time}
+expires, at which point its job is put back in the queue. Only the current
+holder of a lease can finish or renew it, so a worker which stalled past
+its lease can't release a host someone else is now using.
+
+@note: SQLite relies on the filesystem's locking. Most NFS and SMB setups
+    are fine but some are not. Check yours before trusting it with
+    several nodes.
+"""
+
+__appname__ = "Fanfic Downloader for Pocket eBook Readers"
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import os, socket, sqlite3, threading, time, urlparse
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id       INTEGER PRIMARY KEY,
+    url      TEXT NOT NULL,
+    host     TEXT NOT NULL,
+    state    TEXT NOT NULL DEFAULT 'queued',
+    worker   TEXT,
+    queued   REAL,
+    started  REAL,
+    finished REAL,
+    error    TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, host);
+CREATE TABLE IF NOT EXISTS hosts (
+    host      TEXT PRIMARY KEY,
+    worker    TEXT,
+    leased    REAL,
+    available REAL NOT NULL DEFAULT 0
+);
+""" #: Applied by L{JobStore.__init__}. Safe to apply repeatedly.
+
+class JobStore(object):
+    """A queue of story URLs which several workers can safely pull from."""
+    host_delay = 2.0    #: Minimum seconds between a host's last job finishing and its next starting.
+    lease_time = 3600.0 #: Seconds after which a claimed job is assumed abandoned.
+    poll_time  = 30.0   #: Maximum seconds L{claim_all} sleeps before checking for free hosts again.
+    timeout    = 60.0   #: Seconds to wait for another worker to release the database.
+
+    def __init__(self, path, worker=None):
+        """
+        @param path: The SQLite database file. Created if missing.
+        @param worker: A name identifying this worker in the job records.
+            Defaults to C{<hostname>:<pid>}.
+        @type path: str
+        @type worker: str
+        """
+        self.path   = path
+        self.worker = worker or "%s:%d" % (socket.gethostname(), os.getpid())
+        # Autocommit so transactions can be opened explicitly with BEGIN IMMEDIATE
+        self.db = sqlite3.connect(path, timeout=self.timeout, isolation_level=None)
+        self.db.executescript(SCHEMA)
+
+    def add(self, url):
+        """Queue a story URL unless it's already queued or running.
+
+        @return: Whether the URL was queued.
+        @rtype: bool
+        """
+        with self.transaction():
+            if self.db.execute("SELECT 1 FROM jobs WHERE url = ? AND "
+                    "state IN ('queued', 'running')", (url,)).fetchone():
+                return False
+            self.db.execute("INSERT INTO jobs (url, host, queued) VALUES (?, ?, ?)",
+                    (url, urlparse.urlparse(url).netloc, time.time()))
+            return True
+
+    def claim(self):
+        """Claim the oldest queued job whose host is free and lease the host.
+
+        @return: The job ID and URL or C{None} if nothing can be claimed yet.
+        @rtype: (C{int}, C{str})|C{None}
+        """
+        now = time.time()
+        with self.transaction():
+            self.expire_leases(now)
+            row = self.db.execute("""SELECT jobs.id, jobs.url, jobs.host FROM jobs
+                    LEFT JOIN hosts ON hosts.host = jobs.host
+                    WHERE jobs.state = 'queued' AND (hosts.host IS NULL OR
+                        (hosts.worker IS NULL AND hosts.available <= ?))
+                    ORDER BY jobs.id LIMIT 1""", (now,)).fetchone()
+            if not row:
+                return None
+
+            job_id, url, host = row
+            self.db.execute("UPDATE jobs SET state = 'running', worker = ?, "
+                    "started = ? WHERE id = ?", (self.worker, now, job_id))
+            self.db.execute("INSERT OR REPLACE INTO hosts (host, worker, leased, "
+                    "available) VALUES (?, ?, ?, ?)", (host, self.worker, now, now))
+            return job_id, url
+
+    def finish(self, job_id, error=None):
+        """Record a claimed job's outcome and release its host.
+
+        Does nothing if this worker's lease on the job has expired and it
+        was requeued. (See L{expire_leases})
+
+        @param error: The failure, if the job failed.
+        @type error: C{Exception}|C{None}
+
+        @return: Whether this worker still held the job.
+        @rtype: bool
+        """
+        now = time.time()
+        with self.transaction():
+            if not self.db.execute("UPDATE jobs SET state = ?, finished = ?, error = ? "
+                    "WHERE id = ? AND worker = ? AND state = 'running'",
+                    (error and 'failed' or 'done', now, error and str(error) or None,
+                     job_id, self.worker)).rowcount:
+                return False
+            self.db.execute("UPDATE hosts SET worker = NULL, leased = NULL, "
+                    "available = ? WHERE worker = ? AND host = "
+                    "(SELECT host FROM jobs WHERE id = ?)",
+                    (now + self.host_delay, self.worker, job_id))
+            return True
+
+    def renew(self, job_id):
+        """Reset the lease on a claimed job's host so it doesn't expire while
+        the job is still running.
+
+        @return: Whether this worker still held the job.
+        @rtype: bool
+        """
+        with self.transaction():
+            return self.db.execute("UPDATE hosts SET leased = ? WHERE worker = ? AND "
+                    "host = (SELECT host FROM jobs WHERE id = ? AND worker = ? AND "
+                    "state = 'running')", (time.time(), self.worker, job_id,
+                    self.worker)).rowcount > 0
+
+    def keep_alive(self, job_id):
+        """Return a context manager which calls L{renew} from a background
+        thread every quarter of L{lease_time} for as long as it's active.
+
+        Use it around the work for each claimed job."""
+        return _Heartbeat(self, job_id)
+
+    def claim_all(self):
+        """Claim jobs until none remain queued, sleeping while every host with
+        queued jobs is leased by another worker or still cooling down.
+
+        Call L{finish} on each job before asking for the next one.
+
+        @return: A generator of (job ID, URL) tuples.
+        """
+        while True:
+            job = self.claim()
+            if job:
+                yield job
+                continue
+
+            wait = self.next_available()
+            if wait is None:
+                return
+            time.sleep(min(max(wait, 0.1), self.poll_time))
+
+    def next_available(self):
+        """Estimate how long until a queued job can be claimed.
+
+        @return: Seconds to wait or C{None} if nothing is queued.
+        @rtype: C{float}|C{None}
+        """
+        now = time.time()
+        if not self.db.execute("SELECT 1 FROM jobs WHERE state = 'queued'").fetchone():
+            return None
+        soonest = self.db.execute("""SELECT MIN(CASE WHEN hosts.worker IS NULL
+                    THEN hosts.available ELSE hosts.leased + ? END)
+                FROM jobs JOIN hosts ON hosts.host = jobs.host
+                WHERE jobs.state = 'queued'""", (self.lease_time,)).fetchone()[0]
+        return soonest is not None and soonest - now or 0
+
+    def expire_leases(self, now):
+        """Requeue the jobs of workers which have held a host for longer than
+        L{lease_time} and free their hosts. (Call inside a transaction)"""
+        cutoff = now - self.lease_time
+        self.db.execute("""UPDATE jobs SET state = 'queued', worker = NULL,
+                started = NULL WHERE state = 'running' AND host IN
+                (SELECT host FROM hosts WHERE worker IS NOT NULL AND leased < ?)""",
+                (cutoff,))
+        self.db.execute("UPDATE hosts SET worker = NULL, leased = NULL "
+                "WHERE worker IS NOT NULL AND leased < ?", (cutoff,))
+
+    def counts(self):
+        """Count jobs by state.
+
+        @rtype: C{dict}
+        """
+        return dict(self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+    def transaction(self):
+        """Return a context manager for a write transaction which holds the
+        database lock from the start so concurrent claims can't interleave."""
+        return _Transaction(self.db)
+
+    def close(self):
+        self.db.close()
+
+class _Heartbeat(object):
+    """See L{JobStore.keep_alive}."""
+    def __init__(self, store, job_id):
+        self.store  = store
+        self.job_id = job_id
+        self.done   = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.done.set()
+        self.thread.join()
+
+    def run(self):
+        # SQLite connections can't be shared between threads
+        store = JobStore(self.store.path, self.store.worker)
+        store.lease_time = self.store.lease_time
+        try:
+            while not self.done.wait(store.lease_time / 4):
+                try:
+                    if not store.renew(self.job_id):
+                        break # Lost it. finish() will notice.
+                except sqlite3.OperationalError:
+                    pass # Database busy for too long. Try again next time.
+        finally:
+            store.close()
+
+class _Transaction(object):
+    """See L{JobStore.transaction}."""
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.execute(exc_type and "ROLLBACK" or "COMMIT")
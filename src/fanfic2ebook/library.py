@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Library-wide operations for fanfic2ebook"""
+
+__appname__ = "Fanfic Downloader for Pocket eBook Readers"
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import os, re, time, urlparse
+
+from data_structures import Story
+from scrapers import Scraper, prnt
+
+class Library(object):
+    """A directory full of stories previously saved by L{Scraper.download_fic}."""
+    first_chapter_re = re.compile(r"^(?P<name>.+) - 1\.html$"
+        ) #: Used by L{scan} to recognize story directories.
+    host_delay       = 2.0 #: Minimum seconds between update checks on the same host.
+
+    def __init__(self, target=None):
+        """
+        @param target: The directory to scan. Defaults to the current
+            working directory.
+        @type target: str
+        """
+        self.target_dir = os.path.abspath(target or os.getcwd())
+        self.last_request = {}
+
+    def scan(self):
+        """Find all stories in the library.
+
+        Both the target directory itself and its immediate subdirectories are
+        searched, mirroring the layout L{Scraper.get_story_dir} produces.
+
+        @return: L{Story} objects with C{path} (the story directory),
+            C{local_chapters}, and C{last_changed} (newest chapter mtime)
+            properties added, most recently changed first.
+        @rtype: C{list} of L{Story}
+        """
+        dirs = [self.target_dir] + [os.path.join(self.target_dir, x)
+                for x in sorted(os.listdir(self.target_dir))]
+
+        stories = []
+        for fic_dir in dirs:
+            if not os.path.isdir(fic_dir):
+                continue
+            for fname in os.listdir(fic_dir):
+                match = self.first_chapter_re.match(fname)
+                if not match:
+                    continue
+
+                try:
+                    story = Story.from_html(os.path.join(fic_dir, fname), metadata_only=True)
+                except Exception, err:
+                    prnt("Could not read %s: %s" % (os.path.join(fic_dir, fname), err))
+                    continue
+
+                story.path, count, newest = fic_dir, 0, 0
+                while True:
+                    chapter_path = os.path.join(fic_dir, "%s - %d.html" % (
+                            match.group('name'), count + 1))
+                    if not os.path.exists(chapter_path):
+                        break
+                    newest = max(newest, os.path.getmtime(chapter_path))
+                    count += 1
+                story.local_chapters = count
+                story.last_changed = newest
+                stories.append(story)
+
+        stories.sort(key=lambda x: x.last_changed, reverse=True)
+        return stories
+
+    def sweep(self, make_scraper, max_age=None, per_site=None):
+        """Check every story in the library for new chapters.
+
+        Stories are checked most-recently-changed first since those are the
+        ones most likely to still be updating. Each check costs one request
+        via L{Scraper.acquire_chapter} and compares the length of the chapter
+        list it parses against the chapters on disk.
+
+        @param make_scraper: Called with a story URL to construct a L{Scraper}
+            configured like one for the command line.
+        @param max_age: Skip stories which haven't changed in this many days.
+        @param per_site: Check at most this many stories per site.
+        @type make_scraper: C{callable}
+        @type max_age: C{int}|C{float}|C{None}
+        @type per_site: C{int}|C{None}
+
+        @return: (scraper, url, story) tuples for stories with new chapters,
+            suitable for passing to L{Scraper.download_fic}.
+        @rtype: C{list} of (L{Scraper}, C{str}, L{Story})
+        """
+        now, checked, jobs = time.time(), {}, []
+        no_url, stale, deferred = 0, 0, 0
+
+        for local in self.scan():
+            url = local.source_url
+            if not url or not Scraper.get(url):
+                no_url += 1
+                continue
+            if max_age is not None and now - local.last_changed > max_age * 86400:
+                stale += 1
+                continue
+
+            host = urlparse.urlparse(url).netloc
+            if per_site is not None and checked.get(host, 0) >= per_site:
+                deferred += 1
+                continue
+            checked[host] = checked.get(host, 0) + 1
+
+            self.wait_for_host(host)
+            scraper = make_scraper(url)
+            try:
+                remote = scraper.acquire_chapter(url)[1]
+            except Exception, err:
+                prnt("Failed to check %s: %s" % (url, err))
+                continue
+
+            remote_count = len(remote.chapter_urls)
+            if remote_count > local.local_chapters:
+                prnt("Updated story (%d -> %d chapters): %s" % (
+                        local.local_chapters, remote_count, local.title))
+                jobs.append((scraper, url, remote))
+            else:
+                prnt("Story already up to date: %s" % local.title)
+
+        prnt("Sweep checked %d stories (%d updated). Skipped %d stale stories, "
+             "saving %d requests. Deferred %d over the per-site limit. "
+             "%d had no usable source URL. (Retrieve those once by URL to "
+             "record it)" % (sum(checked.values()), len(jobs),
+                 stale, stale, deferred, no_url))
+        return jobs
+
+    def wait_for_host(self, host):
+        """Sleep as necessary to keep requests to a host at least
+        L{host_delay} seconds apart."""
+        wait = self.last_request.get(host, 0) + self.host_delay - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self.last_request[host] = time.time()
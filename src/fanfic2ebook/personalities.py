@@ -25,6 +25,20 @@ class Personality(object):
         """L{Personality} subclasses override this to define post-processor behaviour."""
         pass
 
+    def get_cover(self, story):
+        """Return the story's cover as a local path suitable for C{--cover}
+        or None if there isn't one. (eg. it was a URL which failed to download)"""
+        if story.cover and os.path.isfile(story.cover):
+            return story.cover
+        return None
+
+    def get_series_options(self, story):
+        """Return C{ebook-convert} options placing a volume in its series.
+        (See L{Story.split_volumes<data_structures.Story.split_volumes>})"""
+        if story.volume:
+            return ['--series=%s' % story.series, '--series-index=%d' % story.volume]
+        return []
+
     @classmethod
     def register(cls, personality_class):
         """Register a new personality to be retrieved by L{get} using its
@@ -56,7 +70,7 @@ Personality.register(Personality)
 class BBeBPersonality(Personality):
     """A personality for generating LRF files."""
     name  = 'fanfic2lrf'
-    opts  = {'bundle' : True, 'final_ext' : '.lrf'}
+    opts  = {'bundle' : True, 'final_ext' : '.lrf', 'strip_accents' : True}
 
     def postproc(self, story):
         """Perform the transformation from HTML to LRF."""
@@ -65,8 +79,9 @@ class BBeBPersonality(Personality):
 
         if story.category:
             cmdline.append('--category=%s' % story.category)
-        if story.cover:
-            cmdline.append('--cover=%s' % story.cover)
+        if self.get_cover(story):
+            cmdline.append('--cover=%s' % self.get_cover(story))
+        cmdline.extend(self.get_series_options(story))
         cmdline.append(story.path)
 
         try:
@@ -93,8 +108,9 @@ class EPubPersonality(Personality):
             #TODO: Figure out how the PRS-505 displays ePub subjects.
             #FIXME: replace() commas with something else?
             cmdline.append('--subjects=%s' % story.category)
-        if story.cover:
-            cmdline.append('--cover=%s' % story.cover)
+        if self.get_cover(story):
+            cmdline.append('--cover=%s' % self.get_cover(story))
+        cmdline.extend(self.get_series_options(story))
         cmdline.append(story.path)
 
         try:
@@ -119,6 +135,7 @@ class OEBPersonality(Personality):
         if story.category:
             #FIXME: replace() commas with something else?
             cmdline.append('--subjects=%s' % story.category)
+        cmdline.extend(self.get_series_options(story))
         cmdline.append(story.path)
 
         try:
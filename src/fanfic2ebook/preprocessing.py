@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Pre-processing stages for fanfic2ebook
+
+These operate on the DOM generated by L{Story.to_dom<data_structures.Story.to_dom>}
+just before it's serialized for conversion.
+"""
+
+__appname__ = "Fanfic Downloader for Pocket eBook Readers"
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import re, unicodedata
+
+# Latin-1 and the common typographic punctuation render fine on the PRS-505.
+# Stuff like ō shows up as whitespace.
+PRS505_WHITELIST = frozenset(range(0x00, 0x100) + [
+    0x2013, 0x2014, 0x2018, 0x2019, 0x201C, 0x201D, 0x2022, 0x2026, 0x20AC
+    ]) #: Codepoints the Sony PRS-505 fonts are known to render.
+
+# Only these blocks are worth precomputing. Anything outside them has no
+# sensible ASCII/Latin-1 approximation and is passed through untouched.
+TRANSLIT_RANGES = [
+    (0x0100, 0x0250), # Latin Extended-A and -B
+    (0x1E00, 0x1F00), # Latin Extended Additional
+    (0x2000, 0x2070), # General Punctuation (eg. odd-width spaces)
+    (0xFB00, 0xFB07), # Latin ligatures
+    ] #: Blocks scanned when building a translation table.
+
+NON_DECOMPOSABLE = {
+    u'\u0110': u'D',  u'\u0111': u'd',  # Đ đ
+    u'\u0126': u'H',  u'\u0127': u'h',  # Ħ ħ
+    u'\u0131': u'i',                     # ı
+    u'\u0141': u'L',  u'\u0142': u'l',  # Ł ł
+    u'\u0152': u'OE', u'\u0153': u'oe', # Œ œ
+    u'\u0166': u'T',  u'\u0167': u't',  # Ŧ ŧ
+    } #: Letters with no Unicode decomposition but an obvious equivalent.
+
+class AccentStripper(object):
+    """Replaces characters a reader can't display with rough equivalents it
+    can. (eg. ō becomes o, ǖ becomes ü)
+
+    The translation table (and a regex matching its keys) is computed once per
+    whitelist and shared, so text nodes that need no changes cost a single
+    regex scan and no per-character Python work.
+    """
+    _tables = {} #: Class-level cache of (table, regex) pairs by whitelist.
+
+    def __init__(self, whitelist=PRS505_WHITELIST):
+        """
+        @param whitelist: The codepoints the target device can render.
+        @type whitelist: C{frozenset} of C{int}
+        """
+        self.whitelist = frozenset(whitelist)
+        self.table, self.table_re = self.get_table(self.whitelist)
+
+    def __call__(self, dom):
+        """Transliterate all text nodes in the given DOM in place.
+
+        @type dom: C{lxml.html.HtmlElement}
+        @return: The DOM passed in.
+        """
+        table, table_re = self.table, self.table_re
+        replace = lambda match: table[match.group()]
+        for elem in dom.iter():
+            if elem.text and table_re.search(elem.text):
+                elem.text = table_re.sub(replace, elem.text)
+            if elem.tail and table_re.search(elem.tail):
+                elem.tail = table_re.sub(replace, elem.tail)
+        return dom
+
+    @classmethod
+    def get_table(cls, whitelist):
+        """Retrieve (building if necessary) the translation table for the
+        given whitelist.
+
+        @type whitelist: C{frozenset} of C{int}
+        @return: A dict mapping characters to their replacements and a
+            compiled regex which matches any of those characters.
+        @rtype: C{(dict, re.RegexObject)}
+        """
+        if whitelist not in cls._tables:
+            table = {}
+            for start, end in TRANSLIT_RANGES:
+                for codepoint in xrange(start, end):
+                    if codepoint in whitelist:
+                        continue
+                    char = unichr(codepoint)
+                    replacement = NON_DECOMPOSABLE.get(char,
+                            cls._approximate(char, whitelist))
+                    if replacement is not None:
+                        table[char] = replacement
+            table_re = re.compile(u'[%s]' % u''.join(
+                    re.escape(x) for x in sorted(table)), re.UNICODE)
+            cls._tables[whitelist] = (table, table_re)
+        return cls._tables[whitelist]
+
+    @staticmethod
+    def _approximate(char, whitelist):
+        """Find the closest displayable equivalent of a single character by
+        stripping combining marks one at a time from its decomposition.
+
+        @return: The replacement string or None if there isn't one.
+        """
+        decomposed = unicodedata.normalize('NFKD', char)
+        while decomposed:
+            candidate = unicodedata.normalize('NFC', decomposed)
+            if all(ord(x) in whitelist for x in candidate):
+                return candidate
+            if not unicodedata.combining(decomposed[-1]):
+                return None
+            decomposed = decomposed[:-1]
+        return None
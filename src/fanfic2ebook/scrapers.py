@@ -18,13 +18,16 @@ __author__  = "Stephan Sokolow (deitarion/SSokolow)"
 __license__ = "GNU GPL 2.0 or later"
 
 # stdlib imports
-import errno, os, re, urlparse
+import errno, os, re, time, urlparse
 
 # lxml imports
-from lxml import html
+from lxml import etree, html
 
 # local imports
-from data_structures import Story, Chapter
+from data_structures import Story, Chapter, content_cleaner, image_cleaner
+from events import Events
+from preprocessing import AccentStripper
+from stats import NetworkStats
 
 # -- Hopefully temporary hack to ensure safe stdout output --
 import locale, sys
@@ -40,7 +43,11 @@ class HTTP(object):
     and falls back to urllib2.
     """
     #base_UA = "%s/%s" % (__appname__, "Unknown")
-    shortname = 'fanfic2ebook'
+    shortname  = 'fanfic2ebook'
+    stream     = False #: Parse responses as they arrive. (Bypasses httplib2's cache)
+    chunk_size = 16384 #: Bytes read per chunk when streaming.
+    archive    = None  #: An L{HTTPArchive<archive.HTTPArchive>} to record to or replay from. (Overrides L{stream})
+    stats      = NetworkStats() #: Per-host counters for every retrieval by any instance. (See L{report})
 
     @classmethod
     def set_base_UA(cls, UA_string):
@@ -59,28 +66,146 @@ class HTTP(object):
 
     def __init__(self):
         try:
+            if self.stream:
+                raise ImportError("httplib2 can't stream responses")
             import httplib2
+            from cache import SharedFileCache
             self.cachedir = self.get_cache_dir()
-            self.http = httplib2.Http(httplib2.FileCache(self.cachedir))
+            self.http = httplib2.Http(SharedFileCache(self.cachedir))
             self.full_UA = "%s (httplib2 present. HTTP Cache enabled.)" % self.base_UA
             self.with_httplib2 = True
         except ImportError:
             import urllib2
-            self.full_UA = "%s (httplib2 absent. Local cache only.)" % self.base_UA
+            if self.stream:
+                self.full_UA = "%s (Streaming. Local cache only.)" % self.base_UA
+            else:
+                self.full_UA = "%s (httplib2 absent. Local cache only.)" % self.base_UA
             self.opener = urllib2.build_opener()
             self.opener.addheaders = [('User-agent', self.full_UA)]
             urllib2.install_opener(self.opener)
             self.with_httplib2 = False
 
     def get_dom(self, url):
-        if self.with_httplib2:
+        if self.archive:
+            dom = html.fromstring(self.get_content(url), base_url=url)
+        elif self.with_httplib2:
+            dom = html.fromstring(self.request(url)[1], base_url=url)
+        elif self.stream:
+            dom = self.stream_dom(url)
+        else:
+            start, handle = time.time(), self.opener.open(url)
+            dom = html.parse(handle).getroot()
+            self.report(url, start, handle.info().getheader('Content-Length'), False, handle.code)
+        return dom
+
+    def request(self, url):
+        """Retrieve a page via httplib2 and report it. (See L{report})
+
+        Concurrent requests for the same URL from any process sharing the
+        cache are serialized so only the first one goes to the network.
+
+        @return: The status code and body.
+        @rtype: (C{int}, C{str})
+        """
+        from cache import InFlightLock
+        start, cache = time.time(), self.http.cache
+        before = cache.stamp(url)
+        with InFlightLock(self.cachedir, url):
+            if cache.stamp(url) not in (None, before):
+                # Whoever held the lock just stored it. Don't fetch it again.
+                response = cache.get_response(url)
+                if response:
+                    self.report(url, start, len(response[1]), True, response[0])
+                    return response
+            writes = cache.writes
             resp, content = self.http.request(url, "GET",
                     headers={"User-agent": self.full_UA})
-            dom = html.fromstring(content, base_url=url)
-        else:
-            dom = html.parse(self.opener.open(url)).getroot()
+
+        # httplib2 reports revalidations as cache hits but, unlike fresh
+        # hits, they rewrite the cache entry.
+        revalidated = resp.fromcache and cache.writes != writes
+        self.report(url, start, len(content), resp.fromcache, resp.status, revalidated)
+        return resp.status, content
+
+    def report(self, url, start, size, cached, status, revalidated=False):
+        """Record a retrieval in L{stats} and emit a C{fetch} event.
+        (See L{events})"""
+        host, size = urlparse.urlparse(url).netloc, size and int(size) or 0
+        elapsed = time.time() - start
+        self.stats.record(host, size, revalidated and 'revalidated' or
+                          cached and 'hit' or 'miss', status, elapsed)
+        Events.emit('fetch', url=url, host=host, bytes=size, cached=cached,
+                revalidated=revalidated, status=status, elapsed=elapsed)
+
+    def stream_dom(self, url):
+        """Retrieve a page, feeding it to lxml's incremental parser chunk by
+        chunk as it arrives so parsing overlaps the transfer and the raw body
+        is never held in memory all at once."""
+        start, size = time.time(), 0
+        handle = self.opener.open(url)
+        try:
+            try:
+                parser = html.HTMLParser(encoding=handle.info().getparam('charset'))
+            except LookupError:
+                parser = html.HTMLParser() # Bogus charset. Let libxml2 guess.
+
+            for chunk in iter(lambda: handle.read(self.chunk_size), ''):
+                parser.feed(chunk)
+                size += len(chunk)
+        finally:
+            handle.close()
+        self.report(url, start, size, False, handle.code)
+
+        dom = parser.close()
+        dom.getroottree().docinfo.URL = handle.geturl()
         return dom
 
+    def get_content(self, url):
+        """Retrieve the raw, unparsed body of a page. (For handing off to
+        another process to parse or recording to L{archive})"""
+        if self.archive and self.archive.replay:
+            start = time.time()
+            try:
+                status, content = self.archive.get(url)
+            except KeyError:
+                raise IOError("Not in archive %s: %s" % (self.archive.path, url))
+            self.report(url, start, len(content), True, status)
+            return content
+
+        if self.with_httplib2:
+            status, content = self.request(url)
+        else:
+            start, handle = time.time(), self.opener.open(url)
+            status, content = handle.code, handle.read()
+            self.report(url, start, len(content), False, status)
+
+        if self.archive:
+            self.archive.add(url, status, content)
+        return content
+
+def parse_chapter(scraper, url, content):
+    """Parse, extract, and clean a chapter from its raw HTML.
+
+    This is the CPU-bound half of L{Scraper.acquire_chapter}, split out so it
+    can be run in a C{multiprocessing.Pool}. Only the serialized, cleaned
+    chapter is returned to keep inter-process traffic to a minimum.
+
+    @param scraper: The L{Scraper} (without its L{HTTP} object) to use.
+    @param url: The URL the content was retrieved from.
+    @param content: The raw HTML.
+    @type scraper: L{Scraper}
+    @type url: str
+    @type content: str
+
+    @return: The chapter number, title, and cleaned content serialized as HTML.
+    @rtype: (C{int}, C{unicode}, C{unicode})
+    """
+    dom = html.fromstring(content, base_url=url)
+    html.make_links_absolute(dom, copy=False)
+    chapter = scraper.extract_chapter(dom)
+    return (chapter.number, chapter.title,
+            html.tostring(chapter.content, encoding=unicode, with_tail=False))
+
 class Scraper(object):
     """The base class for fanfiction-to-ebook scrapers."""
     scrapers               = {} #: Scrapers registered to be called by L{get}
@@ -90,14 +215,28 @@ class Scraper(object):
     chapter_select_xpath   = None #: Used by L{acquire_chapter} to find the chapter list.
     chapter_content_xpath  = None #: Used by L{acquire_chapter} to find the chapter content.
     author_url_fragment    = None #: Used by L{acquire_chapter} to find the author's name.
+    author_url_re          = None #: Used by L{get_for_author} to recognize author pages.
+    cover_xpath            = None #: Used by L{get_story_cover} to find the cover image's URL.
+    story_id_re            = None #: Used by L{get_story_id} to identify stories on author pages.
     not_chapters           = ["story index", "table of contents"] #: Must be lowercase.
+    volume_chapters        = None #: If set, L{download_fic} also splits bundles into volumes of this many chapters.
+    volume_bytes           = None #: If set, L{download_fic} also splits bundles into volumes of about this size.
+
+    chapter_count_re       = re.compile(r"Chapters?:\s*(?P<count>\d+)", re.IGNORECASE
+        ) #: Used by L{list_author_stories} to read chapter counts from author pages.
+
+    options_xpath          = etree.XPath(".//option"
+        ) #: Used by L{extract_story} to list chapters in the chapter list.
+    selected_xpath         = etree.XPath("(.//option[@selected])[1]"
+        ) #: Used by L{extract_chapter} to find the current chapter.
 
     chapter_title_re       = re.compile(r"^(?P<num>\d+)\. (?P<name>.*)$"
         ) #: Common to Fanfiction.net, FicWad, and TtH <select> elements.
     fat32_compatibility_re = re.compile('[\x00-\x19\x127"*/:<>?\\|]'
         ) #:Characters not allowed in FAT32 filenames.
 
-    def __init__(self, target=None, bundle=False, final_ext='.out'):
+    def __init__(self, target=None, bundle=False, final_ext='.out', strip_accents=False,
+                 pool=None, assets=None):
         """
         Verifies the validity of the target path.
 
@@ -109,12 +248,25 @@ class Scraper(object):
         @param bundle: Whether to also generate a single-file copy of the story.
         @param final_ext: The extension to use when constructing the 'outfile'
             parameter to be passed to post-processors.
+        @param strip_accents: Whether to replace characters the reader can't
+            display in the single-file bundle. (See L{AccentStripper})
+        @param pool: If provided, chapters are parsed and cleaned in this pool
+            by L{parse_chapter} while the next one downloads.
+        @param assets: If provided, images and covers are kept and retrieved
+            into this store in the background.
         @type target: str
         @type bundle: bool
         @type final_ext: str
+        @type strip_accents: bool
+        @type pool: C{multiprocessing.Pool}
+        @type assets: L{AssetStore<assets.AssetStore>}
         """
         self.bundle     = bundle
         self.final_ext  = final_ext
+        self.preprocessors = strip_accents and [AccentStripper()] or []
+        self.pool       = pool
+        self.assets     = assets
+        self.cleaner    = assets and image_cleaner or content_cleaner
         self.target_dir = os.path.abspath(target or os.getcwd())
         self.verify_target_dir()
         self.http = HTTP()
@@ -142,25 +294,57 @@ class Scraper(object):
         dom = self.http.get_dom(url)
         html.make_links_absolute(dom, copy=False)
 
-        chapter_select  = dom.find(self.chapter_select_xpath)
-        chapter_content = dom.find(self.chapter_content_xpath)
-
-        if not story:
-            author = ''
-            for elem in dom.iterfind('.//a[@href]'):
-                if self.author_url_fragment in elem.get('href'):
-                    author = elem.text
-                    break
-            story = Story(self.get_story_title(dom), author)
-            story.site_name = self.site_name
-            story.category  = self.get_story_category(dom)
-            if chapter_select is not None:
-                options = chapter_select.findall(".//option")
-                if options[0].text.strip().lower() in self.not_chapters:
-                    options = options[1:]
-                story.chapter_urls = [self.resolve_chapter_url(x.get('value'), url, dom) for x in options]
-            else:
-                story.chapter_urls = [url]
+        chapter = self.extract_chapter(dom)
+        if story:
+            Events.emit('chapter', url=url, host=urlparse.urlparse(url).netloc,
+                        number=chapter.number, skipped=False)
+        else:
+            # Priming calls don't count. The chapter will be acquired again.
+            story = self.extract_story(url, dom)
+        return chapter, story
+
+    def extract_story(self, url, dom):
+        """Build a L{Story} from the story-wide metadata in a chapter page.
+
+        @param url: The URL of the chapter page.
+        @param dom: The parsed chapter page with absolute links.
+        @type url: str
+        @type dom: C{lxml.html.HtmlElement}
+
+        @return: A L{Story} object with C{site_name}, C{category},
+            C{source_url}, and C{chapter_urls} filled in.
+        @rtype: L{Story}
+        """
+        selectors = self.get_selectors()
+        chapter_select = self.first(selectors['chapter_select'], dom)
+
+        author = self.first(selectors['author'], dom, fragment=self.author_url_fragment)
+        author = author is not None and author.text or ''
+        story = Story(self.get_story_title(dom), author)
+        story.site_name = self.site_name
+        story.category  = self.get_story_category(dom)
+        story.cover     = self.get_story_cover(dom) or ''
+        story.source_url = url
+        if chapter_select is not None:
+            options = self.options_xpath(chapter_select)
+            if options[0].text.strip().lower() in self.not_chapters:
+                options = options[1:]
+            story.chapter_urls = [self.resolve_chapter_url(x.get('value'), url, dom) for x in options]
+        else:
+            story.chapter_urls = [url]
+        return story
+
+    def extract_chapter(self, dom):
+        """Extract and clean the chapter content from a chapter page.
+
+        @param dom: The parsed chapter page with absolute links.
+        @type dom: C{lxml.html.HtmlElement}
+
+        @rtype: L{Chapter}
+        """
+        selectors = self.get_selectors()
+        chapter_select  = self.first(selectors['chapter_select'], dom)
+        chapter_content = self.first(selectors['chapter_content'], dom)
 
         cleaned = self.custom_content_cleaning(chapter_content)
         if cleaned is not None:
@@ -168,69 +352,322 @@ class Scraper(object):
 
         # Extract metadata from the chapter selector (or recognize its absence)
         if chapter_select is not None:
-            chapter_title_str = chapter_select.find(".//option[@selected]").text
+            chapter_title_str = self.selected_xpath(chapter_select)[0].text
             chapter_title_obj = self.chapter_title_re.match(chapter_title_str)
 
             chapter_title  = chapter_title_obj.group('name')
             chapter_number = int(chapter_title_obj.group('num'))
 
-            chapter = Chapter(chapter_number, chapter_title, chapter_content)
+            chapter = Chapter(chapter_number, chapter_title, chapter_content, self.cleaner)
         else:
-            chapter = Chapter(1, '', chapter_content)
+            chapter = Chapter(1, '', chapter_content, self.cleaner)
 
-        return chapter, story
+        return chapter
 
-    def download_fic(self, url):
+    def download_fic(self, url, story=None):
         """Download and save an entire story as a set of cleaned HTML files.
 
         @param url: The URL of any chapter in the story.
+        @param story: A L{Story} already returned by L{acquire_chapter} for
+            this URL. (Saves re-requesting the chapter list)
         @type url: str
+        @type story: L{Story}
 
-        @return: A L{Story} object with a few extra properties.
+        @return: A L{Story} object with a few extra properties. If bundling
+            and splitting into volumes (See L{volume_chapters}), C{volumes}
+            holds the written volumes. Otherwise, it's empty.
+            C{accents_stripped} records whether the bundle was run through
+            L{AccentStripper}.
         @rtype: L{Story}
         """
         # Prime the story-wide metadata store to get the chapter count
-        story = self.acquire_chapter(url)[1]
+        if story is None:
+            story = self.acquire_chapter(url)[1]
 
         # Minimize the wasted bandwidth if it wasn't possible to avoid it
         # altogether. (and create the target dir if necessary)
-        if os.path.basename(self.target_dir).strip().lower() == story.title.strip().lower():
-            fic_target = self.target_dir
+        fic_target = self.get_story_dir(story.title, create=True)
+        Events.emit('story_start', url=url, title=story.title,
+                    chapters=len(story.chapter_urls))
+
+        if self.assets:
+            self.assets.submit(story.cover)
+            # Each chapter's write waits until its own images are retrieved
+            # so they can download alongside the following chapters.
+            preprocessors, deferred = [self.assets.rewriter(fic_target)], []
         else:
-            fic_target = os.path.join(self.target_dir, self.prepare_filename(story.title))
-            self.verify_target_dir(fic_target, create=True)
+            preprocessors, deferred = [], None
 
+        pending = []
         for pos, chapter_url in enumerate(story.chapter_urls):
-            target   = os.path.join(fic_target, "%s - %s.html" % (
-                            self.prepare_filename(story.title), pos + 1))
+            target   = self.get_chapter_path(fic_target, story.title, pos + 1)
+            if deferred:
+                self.write_deferred(story, deferred, preprocessors)
 
             # Avoid re-downloading whenever possible
             if os.path.exists(target):
                 chap_tmp = Chapter.from_html(target)
                 chap_tmp.path = target
                 story.add_chapters(chap_tmp)
-                prnt("Chapter already exists. Skipping: %s" % target)
+                # Backfill the source URL --sweep needs into chapters saved
+                # before it was recorded. (No-op if already present)
+                if pos == 0 and story.write(target, 1):
+                    prnt("Recorded source URL in existing chapter: %s" % target)
+                else:
+                    prnt("Chapter already exists. Skipping: %s" % target)
+                Events.emit('chapter', url=chapter_url, number=pos + 1, skipped=True,
+                            host=urlparse.urlparse(chapter_url).netloc)
                 continue
 
             if not pos + 1 in story.chapters:
+                if self.pool:
+                    # Parse in the background while the next chapter downloads
+                    content = self.http.get_content(chapter_url)
+                    pending.append((chapter_url, target, self.pool.apply_async(
+                                        parse_chapter, (self, chapter_url, content))))
+                    self.collect_parsed(story, pending, deferred)
+                    continue
+
                 chap_tmp = self.acquire_chapter(chapter_url, story)[0]
                 chap_tmp.path = target
                 story.add_chapters(chap_tmp)
 
-            prnt("Writing %s" % target)
-            story.write(target, pos + 1)
+            if deferred is None:
+                self.write_chapter(story, target, pos + 1)
+            else:
+                deferred.append((target, pos + 1,
+                        self.assets.prefetch(story.chapters[pos + 1].content)))
+
+        self.collect_parsed(story, pending, deferred, wait=True)
+        if deferred:
+            self.write_deferred(story, deferred, preprocessors, wait=True)
+
+        # Everything retrieved is on disk for the next run to resume from but
+        # don't bundle a story with holes in it.
+        missing = len(story.chapter_urls) - len(story.chapters)
+        if missing > 0:
+            raise IOError("%d chapter(s) of %s could not be retrieved" % (missing, story.title))
+
+        if self.assets and story.cover:
+            story.cover = self.assets.get(story.cover) or story.cover
 
         if self.bundle:
             story.path = os.path.join(fic_target,
                 '%s.html' % self.prepare_filename(story.title))
             story.final_path = os.path.join(fic_target,
                 '%s.%s' % (self.prepare_filename(story.title), self.final_ext.lstrip('.')))
+            story.accents_stripped = bool(self.preprocessors)
 
-            prnt("Generating single-file bundle: %s" % story.path)
-            story.write(story.path)
-
+            if story.write(story.path, preprocessors=preprocessors + self.preprocessors):
+                prnt("Generated single-file bundle: %s" % story.path)
+            else:
+                prnt("Single-file bundle unchanged: %s" % story.path)
+
+            story.volumes = []
+            if self.volume_chapters or self.volume_bytes:
+                volumes = story.split_volumes(self.volume_chapters, self.volume_bytes)
+                if len(volumes) > 1:
+                    story.volumes = volumes
+
+            for volume in story.volumes:
+                volume.path = os.path.join(fic_target,
+                    '%s.html' % self.prepare_filename(volume.title))
+                volume.final_path = os.path.join(fic_target,
+                    '%s.%s' % (self.prepare_filename(volume.title), self.final_ext.lstrip('.')))
+                if volume.write(volume.path, preprocessors=preprocessors + self.preprocessors):
+                    prnt("Generated volume %d of %d: %s" % (volume.volume,
+                         len(story.volumes), volume.path))
+            self.remove_stale_volumes(fic_target, story)
+
+        Events.emit('story_finish', url=url, title=story.title,
+                    chapters=len(story.chapters))
         return story
 
+    def remove_stale_volumes(self, fic_target, story):
+        """Delete volume files left over from an earlier run which split the
+        story into more volumes than it has now. (For L{download_fic})
+
+        Volumes are always numbered from 1 without gaps so this stops at the
+        first number with nothing to remove.
+        """
+        number = len(story.volumes) + 1
+        while True:
+            base = os.path.join(fic_target,
+                self.prepare_filename("%s - Volume %d" % (story.title, number)))
+            stale = [path for path in (base + '.html', base + '.stripped.html')
+                     if os.path.exists(path)]
+            if not stale:
+                break
+            for path in stale:
+                os.remove(path)
+                prnt("Removed stale volume: %s" % path)
+            number += 1
+
+    def collect_parsed(self, story, pending, deferred, wait=False):
+        """Add and write out the chapters L{parse_chapter} has finished with
+        so far. (For L{download_fic})
+
+        A chapter which failed to parse is reported and left unwritten so
+        the others are still saved and the next run retries only it.
+
+        @param pending: (url, target path, C{AsyncResult}) tuples. Collected
+            entries are removed.
+        @param deferred: As in L{write_deferred}. Chapters are appended to
+            it rather than written if it isn't None.
+        @param wait: Wait for every pending chapter rather than only
+            collecting the finished ones.
+        """
+        for entry in pending[:]:
+            chapter_url, target, result = entry
+            if not (wait or result.ready()):
+                continue
+            pending.remove(entry)
+
+            try:
+                number, title, content = result.get()
+            except Exception, err:
+                prnt("Failed to parse chapter %s: %s" % (chapter_url, err))
+                Events.emit('error', url=chapter_url, error=err)
+                continue
+
+            chap_tmp = Chapter(number, title, html.fragment_fromstring(content), clean=False)
+            chap_tmp.path = target
+            story.add_chapters(chap_tmp)
+            Events.emit('chapter', url=chapter_url, number=number, skipped=False,
+                        host=urlparse.urlparse(chapter_url).netloc)
+            if deferred is None:
+                self.write_chapter(story, target, number)
+            else:
+                deferred.append((target, number, self.assets.prefetch(chap_tmp.content)))
+
+    def write_deferred(self, story, deferred, preprocessors, wait=False):
+        """Write out the chapters whose images have all been retrieved.
+        (For L{download_fic} when keeping images)
+
+        @param deferred: (target path, chapter number, image C{AsyncResult}s)
+            tuples. Written entries are removed.
+        @param preprocessors: Passed to L{write_chapter}. (Includes the
+            L{AssetStore.rewriter<assets.AssetStore.rewriter>})
+        @param wait: Wait for every chapter's images rather than only
+            writing the chapters which are ready.
+        """
+        for entry in deferred[:]:
+            target, number, images = entry
+            if wait or all(x.ready() for x in images):
+                deferred.remove(entry)
+                self.write_chapter(story, target, number, preprocessors)
+
+    def write_chapter(self, story, target, number, preprocessors=()):
+        """Write a single chapter file for L{download_fic}."""
+        if story.write(target, number, preprocessors):
+            prnt("Writing %s" % target)
+        else:
+            prnt("Chapter unchanged. Not rewriting: %s" % target)
+
+    def list_author_stories(self, url):
+        """Enumerate the stories listed on an author's page.
+
+        @param url: The URL of the author's page.
+        @type url: str
+
+        @return: A list of (url, title, chapter count) tuples in page order.
+            The chapter count is C{None} if the page doesn't give one.
+        @rtype: C{list} of (C{str}, C{unicode}, C{int}|C{None})
+        """
+        dom = self.http.get_dom(url)
+        html.make_links_absolute(dom, copy=False)
+
+        stories, seen = [], {}
+        for elem in dom.iterfind('.//a[@href]'):
+            story_url = elem.get('href')
+            if not self.story_url_re.match(story_url):
+                continue
+
+            # Many pages link both the title and (eg.) the latest chapter.
+            title = (elem.text_content() or '').strip()
+            story_id = self.get_story_id(story_url)
+            if story_id in seen:
+                if title and not stories[seen[story_id]][1]:
+                    stories[seen[story_id]][1] = title
+                continue
+
+            seen[story_id] = len(stories)
+            stories.append([story_url, title, self.get_author_story_chapter_count(elem)])
+        return [tuple(x) for x in stories if x[1]]
+
+    def filter_known_stories(self, stories):
+        """Drop stories which are already fully present in the target
+        directory.
+
+        @param stories: As returned by L{list_author_stories}.
+        @type stories: C{list} of (C{str}, C{unicode}, C{int}|C{None})
+
+        @return: The URLs of stories which are new, have gained chapters, or
+            whose chapter count couldn't be determined without fetching them.
+            (L{download_fic} will still skip any chapters already on disk)
+        @rtype: C{list} of C{str}
+        """
+        queue = []
+        for story_url, title, remote_count in stories:
+            local_count = self.count_local_chapters(title)
+            if not local_count:
+                prnt("New story: %s" % title)
+            elif remote_count is None:
+                prnt("Chapter count unknown. Checking: %s" % title)
+            elif remote_count > local_count:
+                prnt("Updated story (%d -> %d chapters): %s" % (local_count, remote_count, title))
+            else:
+                prnt("Story already up to date. Skipping: %s" % title)
+                continue
+            queue.append(story_url)
+        return queue
+
+    def get_story_dir(self, title, create=False):
+        """Determine the directory in which a story's files belong.
+
+        @param title: The story's title.
+        @param create: Whether to create the directory if it doesn't exist.
+        @type title: basestring
+        @type create: bool
+
+        @rtype: str
+        """
+        if os.path.basename(self.target_dir).strip().lower() == title.strip().lower():
+            return self.target_dir
+
+        fic_target = os.path.join(self.target_dir, self.prepare_filename(title))
+        if create:
+            self.verify_target_dir(fic_target, create=True)
+        return fic_target
+
+    def get_chapter_path(self, fic_target, title, number):
+        """Construct the path at which a single chapter is saved.
+
+        @param fic_target: As returned by L{get_story_dir}.
+        @param title: The story's title.
+        @param number: The 1-based chapter number.
+        @type fic_target: str
+        @type title: basestring
+        @type number: int
+
+        @rtype: str
+        """
+        return os.path.join(fic_target, "%s - %s.html" % (
+                            self.prepare_filename(title), number))
+
+    def count_local_chapters(self, title):
+        """Count the contiguous chapters of a story already present on disk.
+
+        @param title: The story's title.
+        @type title: basestring
+
+        @rtype: int
+        """
+        fic_target, count = self.get_story_dir(title), 0
+        while os.path.exists(self.get_chapter_path(fic_target, title, count + 1)):
+            count += 1
+        return count
+
     def prepare_filename(self, in_str):
         """Given a story title or other unsafe string, sanitize any characters
         which cannot be put into FAT32 long filenames.
@@ -242,6 +679,14 @@ class Scraper(object):
         @rtype: str|unicode"""
         return self.fat32_compatibility_re.sub('_', in_str)
 
+    def __getstate__(self):
+        """Leave out the L{HTTP} object, pool, and asset store so scrapers
+        can be sent to L{parse_chapter} in another process."""
+        state = self.__dict__.copy()
+        for key in ('http', 'pool', 'assets'):
+            state.pop(key, None)
+        return state
+
     def verify_target_dir(self, target=None, create=False):
         """Check the given path to ensure it's suitable for saving stories.
 
@@ -291,10 +736,65 @@ class Scraper(object):
            (eg. source series) that the fic falls into on the host site but
            it is not required."""
         return ''
+    def get_story_cover(self, dom):
+        """Return the URL of the story's cover image as matched by
+           L{cover_xpath} or None. L{Scraper} subclasses may override this
+           if that isn't enough for their site."""
+        src = self.first(self.get_selectors()['cover'], dom)
+        return src and str(src) or None
     def custom_content_cleaning(self, content):
         """L{Scraper} subclasses may override this to implement site-specific
            clean-up of chapter content if necessary"""
         return content
+    def get_story_id(self, url):
+        """Reduce a story URL to something which is the same for every chapter
+           of the story. Uses the first group of L{story_id_re} if present."""
+        match = self.story_id_re and self.story_id_re.search(url)
+        return match and match.group(1) or url
+    def get_author_story_chapter_count(self, link):
+        """L{Scraper} subclasses may override this if the default of looking for
+           L{chapter_count_re} in the text surrounding a story link on the
+           author page doesn't work for their site."""
+        parent = link.getparent()
+        if parent is None or len(set(self.get_story_id(x.get('href'))
+                for x in parent.iterfind('.//a[@href]')
+                if self.story_url_re.match(x.get('href')))) > 1:
+            return None # Ambiguous. Don't risk skipping a changed story.
+        match = self.chapter_count_re.search(parent.text_content())
+        return match and int(match.group('count')) or None
+
+    @classmethod
+    def get_selectors(cls):
+        """Retrieve this class's selectors as compiled C{etree.XPath} objects.
+
+        L{chapter_select_xpath}, L{chapter_content_xpath}, and L{cover_xpath}
+        are compiled once per class (on first use or by L{register}) rather
+        than re-interpreted on every page. The author lookup becomes a single query for the first
+        link containing L{author_url_fragment}.
+
+        @return: A dict with C{chapter_select}, C{chapter_content}, C{author},
+            and C{cover} keys. (C{author} takes a C{fragment} variable)
+        @rtype: C{dict}
+        """
+        # Check __dict__ so subclasses don't inherit their parent's compiled copies.
+        if '_selectors' not in cls.__dict__:
+            cls._selectors = {
+                'chapter_select' : cls.chapter_select_xpath and etree.XPath(cls.chapter_select_xpath),
+                'chapter_content': cls.chapter_content_xpath and etree.XPath(cls.chapter_content_xpath),
+                'author'         : etree.XPath("(.//a[contains(@href, $fragment)])[1]"),
+                'cover'          : cls.cover_xpath and etree.XPath(cls.cover_xpath),
+            }
+        return cls._selectors
+
+    @staticmethod
+    def first(selector, dom, **variables):
+        """Return the first match for a compiled selector or None."""
+        if not selector:
+            return None
+        matches = selector(dom, **variables)
+        if not matches:
+            return None
+        return matches[0]
 
     @classmethod
     def register(cls, scraper_class):
@@ -304,6 +804,7 @@ class Scraper(object):
         @param scraper_class: The scraper class to be registered.
         @type scraper_class: L{Scraper}
         """
+        scraper_class.get_selectors()
         cls.scrapers[scraper_class.story_url_re] = scraper_class
 
     @classmethod
@@ -324,6 +825,23 @@ class Scraper(object):
                 return cls.scrapers[url_re]
         return None
 
+    @classmethod
+    def get_for_author(cls, url):
+        """Retrieve a scraper capable of handling the given author page URL.
+        See L{get} for more information.
+
+        @param url: The URL of an author's page.
+        @type url: str
+
+        @return: The L{Scraper} subclass capable of handling the given URL or
+            None if no capable scraper is found.
+        @rtype: C{class}|C{None}
+        """
+        for scraper_class in cls.scrapers.values():
+            if scraper_class.author_url_re and scraper_class.author_url_re.match(url):
+                return scraper_class
+        return None
+
 class FFNetScraper(Scraper):
     """A fanfic-to-ebook scraper for Fanfiction.net"""
     site_name             = "Fanfiction.net"
@@ -332,6 +850,9 @@ class FFNetScraper(Scraper):
     chapter_select_xpath  = ".//*[@name='chapter']"
     chapter_content_xpath = ".//*[@class='storytext']"
     author_url_fragment   = '/u/'
+    author_url_re         = re.compile(r"http://www.fanfiction.net/u/\d+")
+    cover_xpath           = ".//*[@id='profile_top']//img[contains(@class, 'cimage')]/@src"
+    story_id_re           = re.compile(r"/s/(\d+)")
     story_title_re        = re.compile(r"^(?P<title>.+?)(,? Chapter (?P<chapter>.+?))?, an? (?P<category>.+?)( crossover)? fanfic" +
         " - FanFiction.Net$", re.IGNORECASE ) #: Used to extract the story's title and fandom from <title>
 
@@ -355,6 +876,8 @@ class TtHScraper(Scraper):
     chapter_select_xpath  = ".//select[@id='chapnav']"
     chapter_content_xpath = ".//a[@name='storybody']/.."
     author_url_fragment   = '/AuthorStories-'
+    author_url_re         = re.compile(r"http://www.tthfanfic.org/AuthorStories-\d+")
+    story_id_re           = re.compile(r"(?:Story-|story.php\?no=)(\d+)")
 
     def get_story_title(self, dom):
         """Extract the Twisting the Hellmouth story title"""
@@ -375,6 +898,8 @@ class FicWadScraper(Scraper):
     chapter_select_xpath  = ".//select[@name='goto']"
     chapter_content_xpath = ".//div[@id='storytext']"
     author_url_fragment   = '/author/'
+    author_url_re         = re.compile(r"http://www.ficwad.com/author/\d+")
+    story_id_re           = re.compile(r"/story/(\d+)")
 
     def get_story_title(self, dom):
         """Extract the FicWad story title (Odder than it sounds)"""
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Long-running job server for fanfic2ebook
+
+Keeps the interpreter, lxml, scrapers, and HTTP cache handles warm and
+accepts jobs over a small local HTTP/JSON API:
+
+ - C{POST /jobs} with a JSON object (as C{application/json}) containing
+   C{url} and optionally C{personality} and C{target}, which must be
+   inside the server's own target directory. Responds with the new job.
+ - C{GET /jobs} lists all jobs.
+ - C{GET /jobs/<id>} retrieves a single job's status. Finished jobs
+   include C{formats}: whether each personality's conversion succeeded.
+   They're forgotten after L{JobServer.job_ttl} seconds.
+
+@note: There's no authentication. Only listen on interfaces you trust.
+"""
+
+__appname__ = "Fanfic Downloader for Pocket eBook Readers"
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import BaseHTTPServer, json, os, Queue, threading, time
+
+from events import Events
+from scrapers import Scraper, prnt
+
+class JobRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Maps the job API onto L{JobServer}."""
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['jobs']:
+            self.send_json(200, self.server.get_jobs())
+        elif len(parts) == 2 and parts[0] == 'jobs' and parts[1].isdigit():
+            job = self.server.get_job(int(parts[1]))
+            if job:
+                self.send_json(200, job)
+            else:
+                self.send_json(404, {'error': 'No such job'})
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path.strip('/') != 'jobs':
+            return self.send_json(404, {'error': 'Not found'})
+
+        # Anything else can be sent cross-origin by any web page without
+        # a CORS preflight.
+        if self.headers.gettype() != 'application/json':
+            return self.send_json(415, {'error': 'Content-Type must be application/json'})
+
+        try:
+            length = int(self.headers.getheader('Content-Length') or 0)
+            params = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self.send_json(400, {'error': 'Request body must be JSON'})
+
+        if not isinstance(params, dict) or not params.get('url'):
+            return self.send_json(400, {'error': 'A "url" is required'})
+        for field in ('url', 'personality', 'target'):
+            if not isinstance(params.get(field), (basestring, type(None))):
+                return self.send_json(400, {'error': 'The "%s" must be a string' % field})
+        if not Scraper.get(params['url']):
+            return self.send_json(400, {'error': 'Unsupported URL'})
+        if params.get('target'):
+            params['target'] = self.server.resolve_target(params['target'])
+            if not params['target']:
+                return self.send_json(400, {'error': 'The "target" must be '
+                                            'inside the server\'s target directory'})
+
+        self.send_json(201, self.server.submit(params))
+
+    def send_json(self, code, obj):
+        """Send C{obj} as the JSON response body."""
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class JobServer(BaseHTTPServer.HTTPServer):
+    """Queues submitted jobs and runs them one at a time in a worker thread
+    so the API stays responsive."""
+    allow_reuse_address = True
+    job_ttl = 86400.0 #: Seconds a finished job's status is kept for the API.
+
+    def __init__(self, address, run_job, target_root):
+        """
+        @param address: The (host, port) to listen on.
+        @param run_job: Called in the worker thread with the job's parameters
+            (a C{dict} with C{url} and optionally C{personality} and
+            C{target}). Must return the retrieved L{Story} or raise an
+            exception on failure. If the story has a C{formats} dict of
+            success by personality name, it's reported in the job and any
+            failure fails the job.
+        @param target_root: The directory job targets must be inside.
+            (Relative targets are relative to it)
+        @type address: C{tuple}
+        @type run_job: C{callable}
+        @type target_root: str
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, JobRequestHandler)
+        self.run_job = run_job
+        self.target_root = os.path.realpath(target_root)
+        self.jobs    = {}
+        self.next_id = 1
+        self.lock    = threading.Lock()
+        self.queue   = Queue.Queue()
+
+        worker = threading.Thread(target=self.work)
+        worker.daemon = True
+        worker.start()
+
+    def resolve_target(self, target):
+        """Resolve a job's target directory, following symlinks.
+
+        @return: The absolute path or C{None} if it's outside L{target_root}.
+        @rtype: str|C{None}
+        """
+        path = os.path.realpath(os.path.join(self.target_root, target))
+        if path == self.target_root or path.startswith(
+                os.path.join(self.target_root, '')):
+            return path
+        return None
+
+    def submit(self, params):
+        """Queue a job and return a copy of its status record."""
+        with self.lock:
+            self.prune(time.time() - self.job_ttl)
+            job = {
+                'id'         : self.next_id,
+                'url'        : params['url'],
+                'personality': params.get('personality'),
+                'target'     : params.get('target'),
+                'state'      : 'queued',
+                'submitted'  : time.time(),
+            }
+            self.jobs[job['id']] = job
+            self.next_id += 1
+        self.queue.put(job['id'])
+        return dict(job)
+
+    def prune(self, cutoff):
+        """Forget jobs which finished before C{cutoff} so a long-running
+        server doesn't accumulate them forever. (Call with L{lock} held)"""
+        for job_id, job in self.jobs.items():
+            if job.get('finished', cutoff) < cutoff:
+                del self.jobs[job_id]
+
+    def get_job(self, job_id):
+        """Return a copy of a job's status record or None."""
+        with self.lock:
+            return job_id in self.jobs and dict(self.jobs[job_id]) or None
+
+    def get_jobs(self):
+        """Return copies of all status records in submission order."""
+        with self.lock:
+            return [dict(self.jobs[x]) for x in sorted(self.jobs)]
+
+    def update_job(self, job_id, **fields):
+        """Update a job's status record."""
+        with self.lock:
+            self.jobs[job_id].update(fields)
+
+    def work(self):
+        """Worker thread main loop."""
+        while True:
+            job = self.get_job(self.queue.get())
+            self.update_job(job['id'], state='running', started=time.time())
+            try:
+                story = self.run_job(job)
+            except Exception, err:
+                prnt("Job %d failed: %s" % (job['id'], err))
+                Events.emit('error', url=job['url'], error=err)
+                self.update_job(job['id'], state='failed', error=str(err),
+                                finished=time.time())
+            else:
+                formats = getattr(story, 'formats', {})
+                fields = dict(state='done', finished=time.time(), formats=formats,
+                        title=story.title, bundle=getattr(story, 'path', None),
+                        outfile=getattr(story, 'final_path', None))
+
+                failed = sorted(x for x in formats if not formats[x])
+                if failed:
+                    fields['state'] = 'failed'
+                    fields['error'] = "Conversion failed: %s" % ', '.join(failed)
+                    prnt("Job %d failed: %s" % (job['id'], fields['error']))
+                self.update_job(job['id'], **fields)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Per-site network accounting for fanfic2ebook
+
+L{HTTP<scrapers.HTTP>} records every retrieval in L{HTTP.stats<scrapers.HTTP.stats>}
+so a run can report what each site cost in requests and bandwidth and how
+much the cache saved. Each retrieval is classified as one of:
+
+ - C{hit}: Served from the cache without touching the network.
+ - C{revalidated}: The cached copy was confirmed current by the site.
+   (A round trip but no body transfer)
+ - C{miss}: Retrieved in full. (Always the case without httplib2)
+"""
+
+__appname__ = "Fanfic Downloader for Pocket eBook Readers"
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import json, threading, time
+
+class NetworkStats(object):
+    """Thread-safe per-host request counters."""
+    percentiles = (50, 90, 99) #: Latency percentiles included in L{summary}.
+
+    def __init__(self):
+        self.lock  = threading.Lock()
+        self.hosts = {}
+
+    def record(self, host, size, cache_state, status, elapsed):
+        """Count a single retrieval.
+
+        @param host: The host the URL was on.
+        @param size: Bytes of body retrieved.
+        @param cache_state: C{'hit'}, C{'revalidated'}, or C{'miss'}.
+        @param status: The HTTP status code.
+        @param elapsed: Seconds the retrieval took.
+        @type host: str
+        @type size: int
+        @type cache_state: str
+        @type status: int
+        @type elapsed: float
+        """
+        with self.lock:
+            counters = self.hosts.setdefault(host, {
+                'requests': 0, 'bytes': 0, 'downloaded': 0,
+                'hit': 0, 'revalidated': 0, 'miss': 0,
+                'status': {}, 'latencies': []})
+            counters['requests'] += 1
+            counters['bytes'] += size
+            counters[cache_state] += 1
+            if cache_state == 'miss':
+                counters['downloaded'] += size
+            counters['status'][status] = counters['status'].get(status, 0) + 1
+            counters['latencies'].append(elapsed)
+
+    def summary(self):
+        """Summarize the counters with latencies reduced to percentiles.
+
+        @return: A JSON-serializable dict of per-host dicts.
+        @rtype: C{dict}
+        """
+        with self.lock:
+            result = {}
+            for host, counters in self.hosts.items():
+                latencies = sorted(counters['latencies'])
+                host_result = dict((k, v) for k, v in counters.items() if k != 'latencies')
+                host_result['status'] = dict((str(k), v) for k, v in counters['status'].items())
+                for pct in self.percentiles:
+                    # Nearest-rank method
+                    rank = max(int(round(pct / 100.0 * len(latencies))) - 1, 0)
+                    host_result['p%d' % pct] = latencies[rank]
+                result[host] = host_result
+            return result
+
+    def report(self):
+        """Format L{summary} as human-readable lines. (One or more per host)
+
+        @rtype: C{list} of C{str}
+        """
+        lines = []
+        for host, stats in sorted(self.summary().items()):
+            lines.append("%s: %d requests, %.1f KiB (%.1f KiB downloaded)" % (
+                host, stats['requests'], stats['bytes'] / 1024.0,
+                stats['downloaded'] / 1024.0))
+            lines.append("    cache: %d hits, %d revalidated, %d misses (%.0f%% avoided a download)" % (
+                stats['hit'], stats['revalidated'], stats['miss'],
+                100.0 * (stats['hit'] + stats['revalidated']) / stats['requests']))
+            lines.append("    status: %s | latency: %s" % (
+                ', '.join("%s x%d" % x for x in sorted(stats['status'].items())),
+                ', '.join("p%d %.2fs" % (x, stats['p%d' % x]) for x in self.percentiles)))
+        return lines
+
+    def append_to(self, path):
+        """Append L{summary} to a file as a single timestamped JSON line so
+        successive runs can be compared."""
+        record = json.dumps({'time': time.time(), 'hosts': self.summary()}, sort_keys=True)
+        handle = open(path, 'a')
+        try:
+            handle.write(record + '\n')
+        finally:
+            handle.close()
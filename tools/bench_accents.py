@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time L{AccentStripper} against the rest of a chapter's processing.
+
+Uses the synthetic C{fixtures/accented_chapter.html} (300 paragraphs, each
+ending in a run of characters the PRS-505 can't display) and a copy of it
+with those characters already stripped, so both the rewrite-everything and
+nothing-to-do cases are covered.
+
+Usage: python tools/bench_accents.py [repetitions]
+"""
+
+__appname__ = "Fanfic Downloader for Pocket eBook Readers"
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import copy, os, sys, time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS_DIR, os.pardir, 'src', 'fanfic2ebook'))
+
+from lxml import html
+from data_structures import content_cleaner
+from preprocessing import AccentStripper
+
+def best_of(func, make_arg, repetitions):
+    """Return the fastest of C{repetitions} calls to C{func} in milliseconds.
+    C{make_arg} is called untimed before each one to build its argument."""
+    best = None
+    for _ in range(repetitions):
+        arg = make_arg()
+        start = time.time()
+        func(arg)
+        elapsed = time.time() - start
+        best = best is None and elapsed or min(best, elapsed)
+    return best * 1000
+
+def main():
+    repetitions = len(sys.argv) > 1 and int(sys.argv[1]) or 50
+    raw = open(os.path.join(TOOLS_DIR, 'fixtures', 'accented_chapter.html'), 'rb').read()
+    accented = html.document_fromstring(raw.decode('utf-8'))
+
+    start = time.time()
+    AccentStripper._tables.clear()
+    stripper = AccentStripper()
+    build_ms = (time.time() - start) * 1000
+    plain = stripper(copy.deepcopy(accented))
+
+    print "Fixture: %.1f KiB, %d paragraphs" % (len(raw) / 1024.0,
+            len(accented.findall('.//p')))
+    results = [
+        ("Table build (once per process)", build_ms),
+        ("Parse", best_of(html.document_fromstring,
+                          lambda: raw.decode('utf-8'), repetitions)),
+        ("content_cleaner", best_of(content_cleaner,
+                                    lambda: copy.deepcopy(accented), repetitions)),
+        ("AccentStripper, nothing to do", best_of(stripper,
+                                    lambda: copy.deepcopy(plain), repetitions)),
+        ("AccentStripper, every paragraph", best_of(stripper,
+                                    lambda: copy.deepcopy(accented), repetitions)),
+    ]
+    for label, msecs in results:
+        print "%-32s %6.2f ms" % (label + ':', msecs)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time the precompiled scraper selectors against per-page lookups.
+
+Uses the synthetic Fanfiction.net-style C{fixtures/ffnet_chapter.html}:
+400 story links ahead of the author link, 59 chapter options, and 500
+paragraphs. The "per-page" figures reproduce the lookups L{Scraper} did
+before L{Scraper.get_selectors} existed (C{find()} with the selector
+strings and a Python loop over every link for the author).
+
+Usage: python tools/bench_selectors.py [repetitions]
+"""
+
+__appname__ = "Fanfic Downloader for Pocket eBook Readers"
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import os, sys, time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS_DIR, os.pardir, 'src', 'fanfic2ebook'))
+
+from lxml import html
+from scrapers import FFNetScraper, HTTP
+
+URL = 'http://www.fanfiction.net/s/1000/7/'
+
+def per_page(scraper, dom):
+    """The selector work of extract_story() and extract_chapter() as it was."""
+    chapter_select = dom.find(scraper.chapter_select_xpath)
+    dom.find(scraper.chapter_content_xpath)
+    for elem in dom.iterfind('.//a[@href]'):
+        if scraper.author_url_fragment in elem.get('href'):
+            break
+    chapter_select.findall(".//option")
+    chapter_select.find(".//option[@selected]")
+
+def precompiled(scraper, dom):
+    """The same work through the compiled selectors."""
+    selectors = scraper.get_selectors()
+    chapter_select = scraper.first(selectors['chapter_select'], dom)
+    scraper.first(selectors['chapter_content'], dom)
+    scraper.first(selectors['author'], dom, fragment=scraper.author_url_fragment)
+    scraper.options_xpath(chapter_select)
+    scraper.selected_xpath(chapter_select)
+
+def best_of(func, repetitions):
+    """Return the fastest of C{repetitions} calls to C{func} in milliseconds."""
+    best = None
+    for _ in range(repetitions):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = best is None and elapsed or min(best, elapsed)
+    return best * 1000
+
+def main():
+    repetitions = len(sys.argv) > 1 and int(sys.argv[1]) or 200
+    HTTP.set_base_UA('bench_selectors')
+
+    raw = open(os.path.join(TOOLS_DIR, 'fixtures', 'ffnet_chapter.html'), 'rb').read()
+    dom = html.fromstring(raw, base_url=URL)
+    html.make_links_absolute(dom, copy=False)
+    scraper = FFNetScraper.__new__(FFNetScraper) # No target directory or HTTP needed
+
+    print "Fixture: %.1f KiB" % (len(raw) / 1024.0)
+    results = [
+        ("Selectors, per-page lookups", best_of(lambda: per_page(scraper, dom), repetitions)),
+        ("Selectors, precompiled", best_of(lambda: precompiled(scraper, dom), repetitions)),
+        ("extract_story()", best_of(lambda: scraper.extract_story(URL, dom), repetitions)),
+    ]
+    for label, msecs in results:
+        print "%-30s %6.2f ms" % (label + ':', msecs)
+
+if __name__ == '__main__':
+    main()